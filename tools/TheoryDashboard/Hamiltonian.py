@@ -1,12 +1,33 @@
 import numpy as np
 import ipywidgets as widgets
+import matplotlib
 import matplotlib.pyplot as plt
 
 from tools.TheoryDashboard.helperhamiltonian import *
+from tools.helpers import debounce
 
 import io
 import warnings
+
+def remove_artists(artists):
+    'Removes lines and contour sets from their axes'
+    for artist in artists:
+        try:
+            artist.remove()
+        except AttributeError:                                   # Contour sets before matplotlib 3.8
+            for collection in artist.collections:
+                collection.remove()
         
+def separatrix_summary(sep, x_es):
+    'Stable triangle area and separatrix angles at the septum, as HTML'
+    if sep is None or np.isnan(sep['area']):
+        return 'No separatrix : no unstable fixed points'
+    px_es = separatrix_crossings(sep['arms_x'], sep['arms_px'], x_es)
+    crossings = ', '.join(f'{px*1E3:.3f}' for px in px_es) if len(px_es) else 'none'
+    return (f'Stable area = {sep["area"]*1E6:.3f} mm mrad<br>'
+            f'Fixed points x = {", ".join(f"{x*1E3:.2f}" for x in sep["fixed_x"])} mm<br>'
+            f"Separatrix at ES : px' = {crossings} mrad")
+
 def Hamiltonian_Output(tdf, QX, QX_r, ES, ele_pos, Hamilton_err):
     '''
     Inputs
@@ -31,7 +52,61 @@ def Hamiltonian_Output(tdf, QX, QX_r, ES, ele_pos, Hamilton_err):
         figH, axH = plt.subplots(figsize=(9,8))
         figH.canvas.header_visible = False
         plt.show()
+
+    # Separatrix envelope around the ring, only shown in Ring mode
+    Ring_out = widgets.Output(layout=widgets.Layout(display='none'))
+    with Ring_out:
+        figE, axE = plt.subplots(figsize=(9,3))
+        figE.canvas.header_visible = False
+        plt.show()
         
+    stages = {}                                                  # stage name -> (inputs, result)
+
+    def stage(name, inputs, compute):
+        'Returns the stored result of a stage, recomputing it only if its inputs changed'
+        if name not in stages or stages[name][0] != inputs:
+            stages[name] = (inputs, compute())
+        return stages[name][1]
+
+    def draw_contour(grid):
+        'Replaces the previous drawing with the contour lines of the new grid'
+        if 'drawing' in stages:
+            remove_artists(stages['drawing'][1])
+        xx, xpxp, hh = grid
+        with warnings.catch_warnings():                          # Ignores errors of empty contour lines
+            warnings.simplefilter("ignore")
+            return [axH.contour(xx, xpxp, hh, 500, colors=[matplotlib.colormaps["coolwarm"](0)], linestyles='solid')]
+
+    def draw_separatrix(sep):
+        'Replaces the previous drawing with the separatrix, its arms, the invariant curves and the fixed points'
+        if 'drawing' in stages:
+            remove_artists(stages['drawing'][1])
+        colour = matplotlib.colormaps["coolwarm"](0)
+        if sep is None:
+            return []
+        return (axH.plot(sep['x'], sep['px'], color=colour, linewidth=2)
+                + axH.plot(sep['arms_x'], sep['arms_px'], color=colour, linewidth=2)
+                + axH.plot(sep['curves_x'], sep['curves_px'], color=colour, linewidth=0.8)
+                + axH.plot(sep['fixed_x'], sep['fixed_px'], 'x', color='black'))
+
+    def draw_ring_element(ring, i):
+        'Replaces the previous drawing with the stored separatrix at element number i'
+        if 'drawing' in stages:
+            remove_artists(stages['drawing'][1])
+        if ring is None:
+            return []
+        return (axH.plot(ring['x'][i], ring['px'][i], color=matplotlib.colormaps["coolwarm"](0), linewidth=2)
+                + axH.plot(ring['fixed_x'][i], ring['fixed_px'][i], 'x', color='black'))
+
+    def draw_envelope(ring):
+        'Draws the x extent of the stable triangle against s'
+        axE.clear()
+        if ring is not None:
+            axE.fill_between(ring['s'], ring['x_min'], ring['x_max'], alpha=0.5)
+            axE.set_xlabel('s [m]')
+            axE.set_ylabel('Stable x [m]')
+        return axE.axvline(0, color='black')
+
     def HamiltonPlot(change):
         '''
         Inputs
@@ -42,34 +117,62 @@ def Hamiltonian_Output(tdf, QX, QX_r, ES, ele_pos, Hamilton_err):
             ES              : Electrostatic septa widget
             ele_pos         : Element where hamilton is measured
             
-        If input values change, redraws Hamiltonian & updates plot
+        Runs the chain parse lattice -> virtual multipoles -> Hamiltonian grid or separatrix -> drawing -> render.
+        Each stage is only recomputed when one of its inputs changed, so changing the title,
+        the axis limits or the ES position only redraws the axes.
         
         Output
         ------
            HamiltonOut     : dashboard including widget output and axes inputs
         '''
-        import matplotlib.cm as cm
-        
         if tdf.data != []:                                       #If non-empty Twiss dataframe uploader
-            tdf_bytes = io.BytesIO( tdf.data[0] )                # Converts uploaded file into binary
-            TDF = io.TextIOWrapper(tdf_bytes, encoding='utf-8')  # Unwraps binary values
-            header, twiss_df = readtfs(TDF)                      # Extracts header information and dataframe.
-
-            axH.clear()                                          #Removes previous plot to avoid overlapping contours
-            xx, xpxp, hh = HamiltonianContour(twiss_df, QX.value, QX_r.value, ele_pos.value, rmin.value, rmax.value, ncount.value, Hamilton_err)
+            data = tdf.data[0]
+            # Parsed once per file. The file is kept with the stage so its id stays unique
+            data, (header, twiss_df) = stage('lattice', id(data), lambda: (data, readtfs_cached(data)))
+            strengths = stage('strengths', (id(data), QX.value), lambda: virtual_strengths(twiss_df, QX.value))
+            Ring_out.layout.display = None if method.value == 'Ring' else 'none'
+            if method.value == 'Ring':
+                ring_inputs = (id(data), QX.value, QX_r.value)
+                ring = stage('ring', ring_inputs, lambda: SeparatrixRing(twiss_df, QX.value, QX_r.value, Hamilton_err,
+                                                                           strengths=strengths))
+                element.max = len(twiss_df) - 1
+                stage('drawing', ('Ring',) + ring_inputs + (element.value,), lambda: draw_ring_element(ring, element.value))
+                marker = stage('envelope', ring_inputs, lambda: draw_envelope(ring))
+                if ring is None:
+                    sep_info.value = 'No separatrix : no unstable fixed points'
+                else:
+                    marker.set_xdata([ring['s'][element.value]]*2)
+                    sep_info.value = (f"{ring['name'][element.value]} at s = {ring['s'][element.value]:.3f} m<br>"
+                                      f"Stable area = {ring['area']*1E6:.3f} mm mrad")
+                    figE.canvas.draw_idle()
+            elif method.value == 'Contour':
+                grid_inputs = (id(data), QX.value, QX_r.value, ele_pos.value, rmin.value, rmax.value, ncount.value,
+                               precision.value, refine.value)
+                grid = stage('grid', grid_inputs, lambda: HamiltonianContour(twiss_df, QX.value, QX_r.value, ele_pos.value,
+                                                                               rmin.value, rmax.value, ncount.value, Hamilton_err,
+                                                                               strengths=strengths, dtype=precision.value,
+                                                                               refine=0.5*refine.value))
+                stage('drawing', ('Contour',) + grid_inputs, lambda: draw_contour(grid))
+                sep_info.value = ''
+            else:
+                sep_inputs = (id(data), QX.value, QX_r.value, ele_pos.value, rmax.value)
+                sep = stage('separatrix', sep_inputs, lambda: HamiltonianSeparatrix(twiss_df, QX.value, QX_r.value, ele_pos.value,
+                                                                                      Hamilton_err, Rmax=rmax.value, strengths=strengths))
+                stage('drawing', ('Separatrix',) + sep_inputs, lambda: draw_separatrix(sep))
+                sep_info.value = separatrix_summary(sep, ES.value)
 
-            with warnings.catch_warnings():                      # Ignores errors of empty contour lines
-                warnings.simplefilter("ignore")
-                axH.contour(xx, xpxp, hh, 500, colors=[cm.get_cmap("coolwarm")(0)], linestyles='solid')
-
-            axH.axvline(ES.value, color='black')                 # Draws on position of aperture limit
+            if 'septum' not in stages:
+                stages['septum'] = (None, axH.axvline(ES.value, color='black'))    # Draws on position of aperture limit
+            stages['septum'][1].set_xdata([ES.value, ES.value])
             axH.set_xlabel('x [m]')
             axH.set_ylabel('px')
             axH.set_xlim(xmin.value, xmax.value)
             axH.set_ylim(ymin.value, ymax.value)
             axH.set_title(f'{title.value} - Qx={QX.value}')
 
-            figH.canvas.draw()
+            figH.canvas.draw_idle()
+
+    HamiltonPlot = debounce(0.3, Hamilton_err)(HamiltonPlot)     # Stepping a value several times redraws once
             
     # If either of these change, update Hamiltonian Plot
     tdf.observe(HamiltonPlot, 'data')
@@ -86,19 +189,32 @@ def Hamiltonian_Output(tdf, QX, QX_r, ES, ele_pos, Hamilton_err):
     ymin = widgets.FloatText(value=-0.004, description=r'Y$_{min}$', step=0.001, layout=widgets.Layout(width='200px'))
     ymax = widgets.FloatText(value= 0.004, description=r'Y$_{max}$', step=0.001, layout=widgets.Layout(width='200px'))
     
+    method = widgets.ToggleButtons(options=['Separatrix', 'Contour', 'Ring'], value='Separatrix', description='Method', layout=widgets.Layout(width='auto'))
+    sep_info = widgets.HTML('')
+    element = widgets.IntSlider(value=0, min=0, max=0, description='Ring element', continuous_update=True, layout=widgets.Layout(width='auto'))
     rmin = widgets.FloatText(value= -10, description=r'R$_{min}$ 10^', step=1, layout=widgets.Layout(width='200px'))
     rmax = widgets.FloatText(value= 0.5, description=r'R$_{max}$ 10^', step=1, layout=widgets.Layout(width='200px'))
     ncount = widgets.BoundedIntText(value=500, description=r'N$_{counts}$', step=100, min=1, max=10000, layout=widgets.Layout(width='auto'))
+    precision = widgets.ToggleButtons(options=['float64', 'float32'], value='float64', description='Grid precision', layout=widgets.Layout(width='auto'))
+    refine = widgets.Checkbox(value=False, description='Refine grid near separatrix', layout=widgets.Layout(width='auto'))
     
     spacer1 = widgets.HTML("  ", layout=widgets.Layout(height='100px'))
     spacer2 = widgets.HTML("  ", layout=widgets.Layout(height='20px'))
     
     axes = [title, xmin, xmax, ymin, ymax]
-    contour_vals = [rmin, rmax, ncount]
+    contour_vals = [rmin, rmax, ncount, method, precision, refine, element]
     
-    Axes = widgets.VBox([spacer1, title, widgets.HBox([xmin, xmax]), widgets.HBox([ymin, ymax]), spacer2, widgets.HBox([rmin, rmax]), ncount])
+    Axes = widgets.VBox([spacer1, title, widgets.HBox([xmin, xmax]), widgets.HBox([ymin, ymax]), spacer2, method, widgets.HBox([rmin, rmax]), ncount, precision, refine, element, sep_info])
     [axis.observe(HamiltonPlot, 'value') for axis in axes]
     [cont.observe(HamiltonPlot, 'value') for cont in contour_vals]
     
-    HamiltonOut = widgets.HBox([Hamilton_out, Axes])
+    def element_to_slider(change):
+        'In Ring mode, typing an element name scrolls to its first occurrence'
+        if 'ring' in stages and stages['ring'][1] is not None:
+            rows = np.flatnonzero(stages['ring'][1]['name'] == ele_pos.value)
+            if len(rows):
+                element.value = int(rows[0])
+    ele_pos.observe(element_to_slider, 'value')
+
+    HamiltonOut = widgets.HBox([widgets.VBox([Hamilton_out, Ring_out]), Axes])
     return HamiltonOut
\ No newline at end of file
@@ -5,6 +5,39 @@ import matplotlib.pyplot as plt
 from tools.helpers import *
 
 from ipywidgets import interactive, interact
+from functools import lru_cache
+
+# Unit draws of the particle distribution, shared by every Steinbach diagram and only extended when Np grows
+unit_draws = {'uniform': np.empty(0), 'amplitude': np.empty(0)}
+unit_streams = [np.random.default_rng(seed) for seed in np.random.SeedSequence(1).spawn(2)]
+
+def unit_distribution(Np):
+    '''
+    Returns
+    -------
+        uniform   : Np uniform draws in [-1, 1), scaled by the momentum spread
+        amplitude : Np amplitudes sqrt(|z|/pi) of unit normal draws z, scaled by sqrt(ex)
+    The first particles are the same whatever Np is, so the distribution does not regenerate
+    when a parameter changes.
+    '''
+    n = len(unit_draws['uniform'])
+    if Np > n:
+        unit_draws['uniform'] = np.append(unit_draws['uniform'], unit_streams[0].uniform(-1, 1, Np - n))
+        unit_draws['amplitude'] = np.append(unit_draws['amplitude'], (abs(unit_streams[1].normal(0, 1, Np - n))/np.pi)**0.5)
+    return unit_draws['uniform'][:Np], unit_draws['amplitude'][:Np]
+
+@lru_cache(maxsize=1)
+def stopband_line(S, Q_r):
+    '''
+    Returns
+    -------
+        Q_res+Q_range : range slope is plotted over
+        A_stopb       : amplitude of stop-band region
+    Only recomputed when S or Q_r change.
+    '''
+    Q_range = np.linspace(-0.5, +0.5, 5000)                        # Tune range to plot line
+    A_stopb = (48 * np.pi * 3**0.5)**0.5 * np.abs(Q_range / S )  # Amplitude due to virtual sextupole
+    return Q_r+Q_range, A_stopb
 
 def Steinbach(S, QX, Q_r, dpp, dQX, ex, Np):
     '''
@@ -21,6 +54,7 @@ def Steinbach(S, QX, Q_r, dpp, dQX, ex, Np):
     Calculates slope of resonance region with S.
     Generates gaussian distribution of Np particles using EX, with uniform momentum spread DPP.
     Calculates amplitude and tune of each particle with respect to resonance.
+    The unit draws are cached, ex, dpp and dQX only rescale them.
     
     Returns
     -------
@@ -29,17 +63,194 @@ def Steinbach(S, QX, Q_r, dpp, dQX, ex, Np):
         Q_res+Q_range : range slope is plotted over
         A_stopb       : amplitude of stop-band region
     '''
-    Q_range = np.linspace(-0.5, +0.5, 5000)                        # Tune range to plot line
-    A_stopb = (48 * np.pi * 3**0.5)**0.5 * np.abs(Q_range / S )  # Amplitude due to virtual sextupole
-    
-    # Ensures particle distribution does not regenerate each time a parameter changes
-    np.random.seed(1)
+    SLine, A_stopb = stopband_line(S, Q_r)
+    uniform, amplitude = unit_distribution(Np)
     
-    DPP = np.random.uniform(-dpp, dpp, Np)                       # Beam momentum spread
-    EX = np.random.normal(0, ex, Np)                             # Beam Emittance
-    An = (abs(EX)/np.pi)**0.5                                    # Converts emittance to amplitude
+    DPP = dpp * uniform                                          # Beam momentum spread
+    An = abs(ex)**0.5 * amplitude                                # Amplitude of a gaussian emittance distribution
+
+    return([QX + DPP*dQX, An, SLine, A_stopb ])
+
+STOPBAND = (48 * np.pi * 3**0.5)**0.5                          # A_stopb = STOPBAND * |Q - Q_r| / S
+
+def spill_simulation(time, QX, S, Q_r, dpp, dQX, ex, Np, chunk=10**6, nq=4096, seed=1):
+    '''
+    Inputs
+    -------
+        time  : times of the ramp [s]
+        QX    : horizontal tune at each time, or a constant
+        S     : sextupole strength at each time, or a constant
+        Q_r   : Resonance horizontal tune
+        dpp   : Beam momentum spread
+        dQX   : Beam chromaticity
+        ex    : Beam emittance [m]
+        Np    : Number of particles, drawn and tracked chunk particles at a time
+        chunk : particles per chunk, bounds the memory
+        nq    : number of momentum bins the stop-band is tabulated on
+        seed  : seed of the particle distribution
+
+    Streams particles with the distribution of Steinbach() through the ramp.
+    A particle is extracted at the first time its amplitude reaches the stop-band of its tune,
+    STOPBAND * |QX(t) + dpp*dQX - Q_r| / S(t). The running minimum of the stop-band over time is
+    tabulated once per momentum bin, at the bin edges nearest and furthest from the resonance. Two
+    binary searches bound the extraction time of a particle, which the exact stop-band settles.
+
+    Returns
+    -------
+        spill : dictionary with
+                time              : times of the ramp
+                intensity         : number of particles extracted at each time
+                dpp_mean, dpp_std : momentum offset of the particles extracted at each time
+                dpp_edges, dpp_hist : momentum histogram of all extracted particles
+                extracted         : fraction of the beam extracted by the end of the ramp
+                ripple            : rms / mean of the intensity over the spill
+                peak              : max / mean of the intensity over the spill
+                duty              : duty factor <I>^2 / <I^2> over the spill
+    '''
+    time = np.asarray(time, dtype=float)
+    nt = len(time)
+    QX = np.broadcast_to(np.asarray(QX, dtype=float), time.shape)
+    S = np.broadcast_to(np.asarray(S, dtype=float), time.shape)
+
+    # Running minimum of the stop-band amplitude, for every momentum bin
+    q_max = abs(dQX*dpp)
+    nq = nq if q_max > 0 else 1
+    q = np.linspace(-q_max, q_max, nq)
+    half = q_max/(nq - 1)*(1 + 1E-9) if nq > 1 else 0         # Half bin width, the particles of a bin lie within it
+    dQ = np.abs(QX[None, :] - Q_r + q[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        A_low = np.where(S == 0, np.inf, STOPBAND * np.maximum(dQ - half, 0) / np.abs(S))
+        A_high = np.where(S == 0, np.inf, STOPBAND * (dQ + half) / np.abs(S))
+    A_low = np.minimum.accumulate(A_low, axis=1)             # Reaches a particle no later than its exact stop-band
+    A_high = np.minimum.accumulate(A_high, axis=1)           # Reaches a particle no earlier than its exact stop-band
+    A_cap = np.max(A_high[np.isfinite(A_high)], initial=0) + 1
+    # Rows laid end to end, each rising, so one searchsorted handles the particles of all bins
+    table_low = (np.arange(nq)[:, None]*A_cap - np.minimum(A_low, A_cap)).ravel()
+    table_high = (np.arange(nq)[:, None]*A_cap - np.minimum(A_high, A_cap)).ravel()
+
+    def exact_hit(t, DPP, An):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return STOPBAND * np.abs(QX[t] - Q_r + DPP*dQX) <= An * np.abs(S[t])
+
+    rng = np.random.default_rng(seed)
+    dpp_edges = np.linspace(-dpp, dpp, 101) if dpp > 0 else np.array([-1E-12, 1E-12])
+    intensity, dpp_sum, dpp_sum2 = np.zeros(nt), np.zeros(nt), np.zeros(nt)
+    dpp_hist = np.zeros(len(dpp_edges) - 1)
+    for n in [chunk]*(int(Np)//chunk) + [int(Np) % chunk]:
+        DPP = rng.uniform(-dpp, dpp, n)                         # Beam momentum spread
+        EX = rng.normal(0, ex, n)                               # Beam Emittance
+        An = (abs(EX)/np.pi)**0.5                               # Converts emittance to amplitude
+
+        b = np.clip(np.rint((DPP*dQX + q_max)/(2*q_max)*(nq - 1)), 0, nq - 1).astype(int) if nq > 1 else np.zeros(n, dtype=int)
+        key = b*A_cap - An
+        order = np.argsort(key)                                 # Sorted keys search the table far faster
+        first, last = np.empty(n, dtype=int), np.empty(n, dtype=int)
+        first[order] = np.searchsorted(table_low, key[order])
+        last[order] = np.searchsorted(table_high, key[order])
+        first -= b*nt                                           # Earliest time the particle can be extracted
+        last = np.minimum(last - b*nt, nt - 1)                  # Latest time, or the end of the ramp
+
+        # The exact stop-band is scanned forward from the earliest time, a few steps per pass
+        turn = np.full(n, nt)
+        pending = np.flatnonzero(first < nt)
+        t = first[pending]
+        while len(pending):
+            window = t[:, None] + np.arange(8)
+            hit = (window <= last[pending, None]) & exact_hit(np.minimum(window, nt - 1), DPP[pending, None], An[pending, None])
+            found = hit.any(axis=1)
+            turn[pending[found]] = window[found, hit[found].argmax(axis=1)]
+            t = t + 8
+            keep = ~found & (t <= last[pending])
+            pending, t = pending[keep], t[keep]
+        out = turn < nt
+        intensity += np.bincount(turn[out], minlength=nt)
+        dpp_sum += np.bincount(turn[out], weights=DPP[out], minlength=nt)
+        dpp_sum2 += np.bincount(turn[out], weights=DPP[out]**2, minlength=nt)
+        dpp_hist += np.histogram(DPP[out], dpp_edges)[0]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dpp_mean = dpp_sum / intensity
+        dpp_std = np.sqrt(np.maximum(dpp_sum2 / intensity - dpp_mean**2, 0))
+    spill = {'time': time, 'intensity': intensity, 'dpp_mean': dpp_mean, 'dpp_std': dpp_std,
+             'dpp_edges': dpp_edges, 'dpp_hist': dpp_hist, 'extracted': intensity.sum() / max(int(Np), 1),
+             'ripple': np.nan, 'peak': np.nan, 'duty': np.nan}
+
+    on = np.flatnonzero(intensity)
+    if len(on):
+        I = intensity[on[0]:on[-1] + 1]
+        spill['ripple'] = I.std() / I.mean()
+        spill['peak'] = I.max() / I.mean()
+        spill['duty'] = I.mean()**2 / np.mean(I**2)
+    return spill
+
+def spiral_step(S, ES, phi):
+    '''
+    Inputs
+    -------
+        S   : Virtual sextupole strength
+        ES  : Electrostatic septum position [m]
+        phi : Orientation of separatrices [deg]
+
+    Works element-wise on arrays.
+
+    Returns
+    -------
+        dR  : Spiral step [m]
+        dRp : Spiral kick
+    '''
+    dR = 3/4 * S / np.cos(rad(phi)) * ES**2
+    dRp = 3/4 * S * np.tan(rad(phi)) / np.cos(rad(phi)) * ES**2
+    return dR, dRp
+
+def hardt_chromaticity(S, QX, DX, DXp, alf, mues, muxr):
+    '''
+    Inputs
+    -------
+        S, QX     : Virtual sextupole strength and horizontal tune
+        DX, DXp   : Dispersion and its derivative at the ES
+        alf       : Orientation [deg]
+        mues      : Phase-advance at ES [deg]
+        muxr      : Phase-advance at virtual resonant sextupole [deg]
 
-    return([QX + DPP*dQX, An, Q_r+Q_range, A_stopb ])
+    Works element-wise on arrays.
+
+    Returns
+    -------
+        dqx_hardt : Chromaticity fulfilling the Hardt condition
+    '''
+    dmu = 360 - ((mues - muxr) / QX * 360)
+    return (-S / (4 * np.pi)) * (DX * np.cos(rad(alf) - rad(dmu)) + DXp * np.sin(rad(alf) - rad(dmu)))
+
+DESIGN_PARAMETERS = ['S', 'QX', 'ES', 'phi', 'DX', 'DXp', 'alf', 'mues', 'muxr']
+
+def design_sweep(axes, **values):
+    '''
+    Inputs
+    -------
+        axes   : dictionary parameter name -> 1D array of values, one grid axis per parameter, in order
+        values : value of every other parameter of DESIGN_PARAMETERS
+
+    Evaluates spiral_step() and hardt_chromaticity() on the whole grid at once. Every parameter
+    is broadcast along its own axis, so only the results are allocated at full size.
+
+    Returns
+    -------
+        maps : dictionary of len(axes[0]) x len(axes[1]) x ... arrays
+               spiral_step, spiral_kick, hardt_chroma
+    '''
+    params = dict(values)
+    for k, (name, grid) in enumerate(axes.items()):
+        shape = [1]*len(axes)
+        shape[k] = -1
+        params[name] = np.reshape(np.asarray(grid, dtype=float), shape)
+    shape = [len(grid) for grid in axes.values()]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dR, dRp = spiral_step(params['S'], params['ES'], params['phi'])
+        chroma = hardt_chromaticity(params['S'], params['QX'], params['DX'], params['DXp'],
+                                    params['alf'], params['mues'], params['muxr'])
+    return {'spiral_step': np.broadcast_to(dR, shape), 'spiral_kick': np.broadcast_to(dRp, shape),
+            'hardt_chroma': np.broadcast_to(chroma, shape)}
 
 def Steinbach_Output(st_in, st_out, spiral_in, hardt_in):
     '''
@@ -86,6 +297,13 @@ def Steinbach_Output(st_in, st_out, spiral_in, hardt_in):
             axS.set_ylim(ymin.value, ymax.value)
             axS.set_title(f"{steinbach_title.value}")
             figS.canvas.draw_idle()
+
+    def updateAxes(change):
+        'Axis limits and title only need a redraw'
+        axS.set_xlim(xmin.value, xmax.value)
+        axS.set_ylim(ymin.value, ymax.value)
+        axS.set_title(f"{steinbach_title.value}")
+        figS.canvas.draw_idle()
     
     # Plots initial default steinbach
     particle_Q, particle_E, SLine, ALine = Steinbach(S.value,QX.value,QX_r.value,DPP.value,DQX.value,ex.value,Np.value)
@@ -108,8 +326,7 @@ def Steinbach_Output(st_in, st_out, spiral_in, hardt_in):
             
         If spiral_in values change, updates value of Spiral Step and Spiral Kick
         '''
-        dR = 3/4 * S.value / np.cos(rad(phi.value)) * ES.value**2
-        dRp = 3/4 * S.value * np.tan(rad(phi.value)) / np.cos(rad(phi.value)) * ES.value**2
+        dR, dRp = spiral_step(S.value, ES.value, phi.value)
         spir.value = round(dR, 3)
         kick.value = round(dRp, 4) 
         
@@ -122,8 +339,7 @@ def Steinbach_Output(st_in, st_out, spiral_in, hardt_in):
         If hardt_in values change AND Calculate Hardt Condition is ticked, updates chromaticity
         '''
         if hardt_chroma.value == True:
-            dmu = 360 - ((mues.value - muxr.value) / QX.value * 360)
-            dqx_hardt = (-S.value / (4 * np.pi)) * (DX.value * np.cos(rad(alf.value) - rad(dmu)) + DXp.value * np.sin(rad(alf.value) - rad(dmu)))
+            dqx_hardt = hardt_chromaticity(S.value, QX.value, DX.value, DXp.value, alf.value, mues.value, muxr.value)
             DQX.value = dqx_hardt
             DQX.disabled = True
         if hardt_chroma.value == False:
@@ -145,6 +361,137 @@ def Steinbach_Output(st_in, st_out, spiral_in, hardt_in):
     axes = [steinbach_title, xmin, xmax, ymin, ymax]
     
     Axes = widgets.VBox([steinbach_title, widgets.HBox([xmin, xmax]), widgets.HBox([ymin, ymax])])
-    [axis.observe(updateSteinbach, 'value') for axis in axes]
+    [axis.observe(updateAxes, 'value') for axis in axes]
     
-    return Axes
\ No newline at end of file
+    return Axes
+
+def Spill_Output(st_in, spill_out):
+    '''
+    Inputs
+    -------
+        st_in     : List of Steinbach inputs - S, QX, QX_r, DPP, DQX, ex, Np
+        spill_out : Output widget the spill is plotted in
+
+    Ramps the tune from QX and the sextupole from S to the end values linearly over the spill,
+    and plots the extracted intensity and momentum from spill_simulation().
+
+    Returns
+    -------
+        SpillInputs : widget box with the ramp inputs and spill metrics
+    '''
+    S, QX, QX_r, DPP, DQX, ex, Np = st_in
+
+    QX_end = widgets.FloatText(value=QX_r.value, description=r'$Q_X$ end', step=0.001, layout=widgets.Layout(width='200px'))
+    S_end = widgets.FloatText(value=S.value, description=r'$S$ end', step=0.25, layout=widgets.Layout(width='200px'))
+    duration = widgets.FloatText(value=1, description='Spill [s]', step=0.1, layout=widgets.Layout(width='200px'))
+    nsteps = widgets.BoundedIntText(value=1000, min=2, max=10**6, description='Time bins', step=100, layout=widgets.Layout(width='200px'))
+    nparticles = widgets.BoundedIntText(value=10**6, min=1, max=10**9, description='Particles', step=10**6, layout=widgets.Layout(width='200px'))
+    run = widgets.Button(description='Simulate spill')
+    metrics = widgets.HTML('')
+
+    with spill_out:
+        figP, (axI, axD) = plt.subplots(2, 1, figsize=(10,5), sharex=True)
+        figP.canvas.header_visible = False
+        plt.show()
+
+    def SpillSim(b):
+        'Runs the spill simulation for the current ramp and plots it'
+        time = np.linspace(0, duration.value, nsteps.value)
+        spill = spill_simulation(time, np.linspace(QX.value, QX_end.value, nsteps.value),
+                                 np.linspace(S.value, S_end.value, nsteps.value),
+                                 QX_r.value, DPP.value, DQX.value, ex.value, nparticles.value)
+        axI.clear(), axD.clear()
+        axI.plot(spill['time'], spill['intensity'])
+        axI.set_ylabel('Extracted particles')
+        axD.plot(spill['time'], spill['dpp_mean'])
+        axD.fill_between(spill['time'], spill['dpp_mean'] - spill['dpp_std'], spill['dpp_mean'] + spill['dpp_std'], alpha=0.3)
+        axD.set_ylabel(r'$\frac{\Delta p}{p}$ extracted')
+        axD.set_xlabel('Time [s]')
+        figP.canvas.draw_idle()
+        metrics.value = (f"Extracted : {spill['extracted']*100:.1f} %<br>Ripple (rms/mean) : {spill['ripple']:.3f}<br>"
+                         f"Peak/mean : {spill['peak']:.3f}<br>Duty factor : {spill['duty']:.3f}")
+
+    run.on_click(SpillSim)
+
+    return widgets.VBox([QX_end, S_end, duration, nsteps, nparticles, run, metrics])
+
+def Design_Output(design_in, design_out):
+    '''
+    Inputs
+    -------
+        design_in  : List of the widgets of DESIGN_PARAMETERS, in the same order
+        design_out : Output widget the heatmap is plotted in
+
+    Heatmap of spiral step, spiral kick or Hardt chromaticity over two chosen parameters,
+    optionally sliced along a third. All other parameters keep their dashboard values.
+
+    Returns
+    -------
+        DesignInputs : widget box choosing the grid
+    '''
+    current = dict(zip(DESIGN_PARAMETERS, design_in))
+    labels = {'Spiral step [m]': 'spiral_step', 'Spiral kick': 'spiral_kick', 'Hardt chromaticity': 'hardt_chroma'}
+
+    def axis_inputs(name, value, vmin, vmax):
+        return [widgets.Dropdown(options=value, value=name, layout=widgets.Layout(width='100px')),
+                widgets.FloatText(value=vmin, description='from', layout=widgets.Layout(width='150px')),
+                widgets.FloatText(value=vmax, description='to', layout=widgets.Layout(width='150px')),
+                widgets.BoundedIntText(value=1000, min=2, max=10**4, description='n', layout=widgets.Layout(width='150px'))]
+    x_in = axis_inputs('ES', DESIGN_PARAMETERS, 0.02, 0.08)
+    y_in = axis_inputs('phi', DESIGN_PARAMETERS, 0, 80)
+    z_in = axis_inputs('None', ['None'] + DESIGN_PARAMETERS, 30, 40)
+    z_in[3].value = 10
+    quantity = widgets.Dropdown(options=list(labels), value='Spiral step [m]', description='Map')
+    z_slice = widgets.IntSlider(value=0, min=0, max=9, description='Slice')
+    plot = widgets.Button(description='Plot')
+    design_err = widgets.Output()
+    maps = {}
+
+    with design_out:
+        figD, axD = plt.subplots(figsize=(10,5))
+        figD.canvas.header_visible = False
+        plt.show()
+    colorbar = []
+
+    def DesignSweep(b):
+        'Evaluates the maps on the chosen grid'
+        design_err.clear_output()
+        names = [inputs[0].value for inputs in [x_in, y_in, z_in] if inputs[0].value != 'None']
+        if len(set(names)) < len(names):
+            with design_err:
+                CRED = '\033[91m'
+                CEND = '\033[0m'
+                print(CRED + 'Error: each axis needs a different parameter' + CEND)
+            return
+        axes = {inputs[0].value: np.linspace(inputs[1].value, inputs[2].value, inputs[3].value)
+                for inputs in [x_in, y_in, z_in] if inputs[0].value != 'None'}
+        values = {name: widget.value for name, widget in current.items() if name not in axes}
+        maps.clear()
+        maps.update(design_sweep(axes, **values), axes=axes)
+        z_slice.max = z_in[3].value - 1 if z_in[0].value != 'None' else 0
+        DesignPlot(None)
+
+    def DesignPlot(change):
+        'Draws the chosen map, or its chosen slice'
+        if not maps:
+            return
+        (x_name, x), (y_name, y), *z = maps['axes'].items()
+        data = maps[labels[quantity.value]]
+        title = quantity.value
+        if z:
+            z_name, z = z[0]
+            data = data[..., min(z_slice.value, len(z) - 1)]
+            title += f' at {z_name} = {z[min(z_slice.value, len(z) - 1)]:.4g}'
+        for cb in colorbar:
+            cb.remove()
+        axD.clear()
+        mesh = axD.pcolormesh(x, y, data.T, shading='auto', rasterized=True)
+        colorbar[:] = [figD.colorbar(mesh, ax=axD)]
+        axD.set_xlabel(x_name), axD.set_ylabel(y_name), axD.set_title(title)
+        figD.canvas.draw_idle()
+
+    plot.on_click(DesignSweep)
+    quantity.observe(DesignPlot, 'value')
+    z_slice.observe(DesignPlot, 'value')
+
+    return widgets.VBox([widgets.HBox(x_in), widgets.HBox(y_in), widgets.HBox(z_in), quantity, z_slice, widgets.HBox([plot, design_err])])
@@ -66,10 +66,14 @@ def TheoryDashboard():
     StAxes = Steinbach_Output(Steinbach_inputs, Stbach_out, Spiral_Step, Hardt)
     SteinbachOut = widgets.HBox([Stbach_out, StAxes])
     HamiltonOut = Hamiltonian_Output(tdf, QX, QX_r, ES, ele_pos, Hamilton_err)
+    Spill_out = widgets.Output()
+    SpillOut = widgets.HBox([Spill_out, Spill_Output(Steinbach_inputs, Spill_out)])
+    Design_out = widgets.Output()
+    DesignOut = widgets.VBox([Design_Output([S, QX, ES, phi, DX, DXp, alf, mues, muxr], Design_out), Design_out])
         
     outtab = widgets.Tab()                           #Makes a tab of Steinbach & Hamiltonian Outputs
-    outtab.children = SteinbachOut, HamiltonOut
-    outtab.set_title(0, "Steinbach"), outtab.set_title(1, "Hamiltonian")
+    outtab.children = SteinbachOut, HamiltonOut, SpillOut, DesignOut
+    outtab.set_title(0, "Steinbach"), outtab.set_title(1, "Hamiltonian"), outtab.set_title(2, "Spill"), outtab.set_title(3, "Design")
 
     '====================== Display Dashboard ============================'
     Dashboard = widgets.VBox([widgets.HBox([col_param, col_spiral, col_hardt, col_ham]), outtab]) 
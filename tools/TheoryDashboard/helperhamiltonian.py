@@ -4,6 +4,62 @@ import matplotlib.pyplot as plt
 import pandas as pd 
 import numpy as np
 import os
+import io
+import hashlib
+from collections import OrderedDict
+
+lattice_cache = OrderedDict()
+
+def lattice_sums(twiss_df, maxsize=8):
+    """
+    Tune independent part of the virtual multipole strengths and the optics of every element,
+    computed once per lattice.
+
+    Arguments:
+      - twiss_df: twiss pandas dataframe, e.g. from readtfs_cached()
+    Returns:
+      - sums: dictionary with
+              sext_sin, sext_cos : sums of k2l betx^(3/2) sin(3 mux) and cos(3 mux) over the sextupoles
+              oct                : sum of k3l betx^2 over the octupoles
+              optics             : element name -> (betx, alfx, mux) at its first occurrence
+              dispersion         : element name -> (dx, dpx), zero if the table has no dispersion
+    """
+    key = id(twiss_df)
+    if key in lattice_cache:
+        lattice_cache.move_to_end(key)
+        return lattice_cache[key][1]
+
+    k2l = twiss_df["k2l"].to_numpy(dtype=float)
+    k3l = twiss_df["k3l"].to_numpy(dtype=float)
+    betx = twiss_df["betx"].to_numpy(dtype=float)
+    phases = 2*np.pi*twiss_df["mux"].to_numpy(dtype=float)
+
+    sext = k2l != 0
+    seStr = k2l[sext]*betx[sext]**(3/2)
+    octs = k3l != 0
+    first = ~twiss_df.index.duplicated()
+    optics = twiss_df.loc[first, ["betx", "alfx", "mux"]]
+    dispersion = twiss_df.loc[first, [col for col in ["dx", "dpx"] if col in twiss_df]].reindex(columns=["dx", "dpx"], fill_value=0)
+    sums = {"sext_sin": np.sum(seStr*np.sin(3*phases[sext])),
+            "sext_cos": np.sum(seStr*np.cos(3*phases[sext])),
+            "oct": np.sum(k3l[octs]*betx[octs]**2),
+            "optics": dict(zip(optics.index, optics.itertuples(index=False, name=None))),
+            "dispersion": dict(zip(dispersion.index, dispersion.itertuples(index=False, name=None)))}
+
+    lattice_cache[key] = (twiss_df, sums)    # Keeps the dataframe alive so its id is not reused
+    if len(lattice_cache) > maxsize:
+        lattice_cache.popitem(last=False)
+    return sums
+
+def get_optics(twiss_df, ele):
+    """
+    Arguments:
+      - twiss_df: twiss pandas dataframe
+      - ele: element name, as in the NAME column
+    Returns:
+      - (betx, alfx, mux) at the element, raises KeyError if it is not in the lattice
+    """
+    return lattice_sums(twiss_df)["optics"][ele]
 
 def get_p3rtilde(twiss_df, nu):
     """
@@ -17,18 +73,11 @@ def get_p3rtilde(twiss_df, nu):
                               N.B. All the active sextupoles are used for the computations, also the
                               chromatic ones.
     """
-    dfRStr = twiss_df.copy()
-    lsTotDf = dfRStr[ dfRStr["k2l"] != 0 ].copy()
-    
-    strongest_sexts = lsTotDf.k2l.abs().sort_values(ascending=False).head(10).index
-    #print(twiss_df.loc[strongest_sexts][['k2l', 'betx', 's', 'mux', 'l']])
+    sums = lattice_sums(twiss_df)
     
     factor = np.sqrt(2)/(24*np.pi*np.sqrt(nu))
-    normTotSeStr = factor*np.array(np.array(lsTotDf["k2l"])*np.array(lsTotDf["betx"].pow(3/2)) )
-    totSePhases = 2*np.pi*np.array(lsTotDf["mux"])
-
-    totSeSinSum = np.sum( normTotSeStr*np.sin(3*totSePhases) )
-    totSeCosSum = np.sum( normTotSeStr*np.cos(3*totSePhases) )
+    totSeSinSum = factor*sums["sext_sin"]
+    totSeCosSum = factor*sums["sext_cos"]
 
     totVStr = np.sqrt( np.power(totSeSinSum,2) + np.power(totSeCosSum,2) )
     totVPhase = np.arctan2((totSeSinSum ),( totSeCosSum ))/3
@@ -45,16 +94,8 @@ def get_p40tilde(twiss_df, nu):
     Returns:
       - totVStr: normalized strength of the virtual octupole.
     """
-    
-    dfRStr = twiss_df.copy()
-    lsTotDf = dfRStr[ dfRStr["k3l"] != 0 ].copy()
-
-    strongest_octs = lsTotDf.k3l.abs().sort_values(ascending=False).head(10).index
-    #print(twiss_df.loc[strongest_octs][['k3l', 'betx', 's', 'mux', 'l']])
-    
     factor = 1/(32*nu*np.pi)
-    normTotOcStr = factor*np.array(np.array(lsTotDf["k3l"])*np.array(lsTotDf["betx"].pow(2)) )
-    totVStr = np.sum(normTotOcStr)
+    totVStr = factor*lattice_sums(twiss_df)["oct"]
 
     return totVStr
 
@@ -95,10 +136,30 @@ def get_delta_omega(dnu, p40tilde, pnrtilde, j0, n):
     return delta, omega
 
 
+def tfs_value(fmt, value):
+    'Converts a TFS header value using its % format instead of eval'
+    if fmt.endswith('s'):
+        return value.strip('"')
+    if fmt.endswith('d'):
+        return int(value)
+    return float(value)
+
+def tfs_dtype(fmt):
+    'Column type of a TFS % format'
+    if fmt.endswith('s'):
+        return str
+    if fmt.endswith('d'):
+        return np.int64
+    return np.float64
+
 def readtfs(filename, usecols=None, index_col=0, check_lossbug=True):
-    '''Reads twiss file into pandas df.'''
+    '''
+    Reads twiss file into pandas df.
+    Header, column names and column types are read line by line, then the table is parsed from
+    the same position in one typed pass, so no column is re-parsed or coerced afterwards.
+    usecols selects columns by name, in any case. The index column is always kept.
+    '''
     header = {}
-    nskip = 0
     closeit = False
     try:
         datafile = open(filename, 'r')
@@ -106,22 +167,27 @@ def readtfs(filename, usecols=None, index_col=0, check_lossbug=True):
     except TypeError:
         datafile = filename
 
-    for line in datafile:
-        nskip += 1
+    line = datafile.readline()
+    while line:
         if line.startswith('@'):
-            entry = line.strip().split()
-            header[entry[1]] = eval(' '.join(entry[3:]))
+            entry = line.strip().split(None, 3)
+            header[entry[1]] = tfs_value(entry[2], entry[3] if len(entry) > 3 else '')
         elif line.startswith('*'):
-            colnames = line.strip().split()[1:]
+            colnames = line.split()[1:]
+        elif line.startswith('$'):
+            coltypes = dict(zip(colnames, [tfs_dtype(fmt) for fmt in line.split()[1:]]))
             break
+        line = datafile.readline()
 
-    if closeit:
-        datafile.close()
+    if usecols is not None:
+        wanted = [col.lower() for col in usecols] + [colnames[index_col].lower()]
+        usecols = [col for col in colnames if col.lower() in wanted]
 
-    table = pd.read_csv(filename, delim_whitespace = True,
-                        skipinitialspace = True,
-                        names = colnames, usecols = usecols,
+    table = pd.read_csv(datafile, sep=r'\s+', header=None, quotechar='"',
+                        names = colnames, usecols = usecols, dtype = coltypes,
                         index_col = index_col)
+    if closeit:
+        datafile.close()
 
     if check_lossbug:
         try:
@@ -131,70 +197,478 @@ def readtfs(filename, usecols=None, index_col=0, check_lossbug=True):
         try:
             for location in table['ELEMENT'].unique():
                 if not location.replace(".","").replace("_","").replace('$','').isalnum():
-                    print("WARNING: some loss locations in "+filename+
+                    print("WARNING: some loss locations in "+str(filename)+
                           " don't reduce to alphanumeric values. For example "+location)
                     break
                 if location=="nan":
-                    print("WARNING: some loss locations in "+filename+" are 'nan'.")
+                    print("WARNING: some loss locations in "+str(filename)+" are 'nan'.")
                     break
         except KeyError:
             pass
-        
-    table = table.drop(index='$')
-    cols = table.columns[1:]
-    table = table.drop('N1', 1)
-    table.columns = cols
-    for col in table.columns[1:]:
-        table[col] = pd.to_numeric(table[col],errors = 'coerce')
+
     table.columns= table.columns.str.strip().str.lower()
     return header, table
 
-def HamiltonianContour(tdf, nu, nu_res, ele, Rmin, Rmax, ncount, output, title=''):   
-    import matplotlib.cm as cm
-    cmap = cm.get_cmap("coolwarm")
+tfs_cache = OrderedDict()
+
+def readtfs_cached(data, usecols=None, maxsize=8):
+    '''
+    Inputs
+    -------
+        data    : contents of a TFS file, e.g. the bytes of an uploaded file
+        usecols : columns to read, see readtfs()
+        maxsize : number of parsed tables kept
+
+    readtfs() with the result cached on a hash of the contents, so re-reading the same lattice is free.
+    The returned dataframe is shared between calls and should not be modified.
+    '''
+    key = (hashlib.sha1(data).hexdigest(), None if usecols is None else tuple(usecols))
+    if key in tfs_cache:
+        tfs_cache.move_to_end(key)
+        return tfs_cache[key]
+    tfs_cache[key] = readtfs(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'), usecols=usecols)
+    if len(tfs_cache) > maxsize:
+        tfs_cache.popitem(last=False)
+    return tfs_cache[key]
+
+J0 = 0.0002                 # Action normalising the radial Hamiltonian, r = J/J0
+OCTUPOLE_FACTOR = 1.2       # Scaling of the virtual octupole in the plotted Hamiltonian
+
+def virtual_strengths(tdf, nu):
+    '''
+    Returns
+    -------
+        p3rtilde, mux_sext : strength and phase of the virtual sextupole
+        p40tilde           : strength of the virtual octupole
+    '''
+    p3rtilde, mux_sext = get_p3rtilde(tdf, nu)
+    p40tilde = get_p40tilde(tdf, nu)
+    return p3rtilde, mux_sext, p40tilde
+
+def element_error(output, ele):
+    with output:
+        output.clear_output()
+        CRED = '\033[91m'
+        CEND = '\033[0m'
+        print(CRED + f'ERROR : Element {ele} not found in lattice.' + CEND)
+
+GRID_MEMORY = 2**28         # Bytes of temporaries HamiltonianContour() may use at once
+
+def radial_axis(Rmin, Rmax, npoints, delta, omega, refine=0):
+    '''
+    Inputs
+    -------
+        Rmin, Rmax   : r spans 10^Rmin to 10^Rmax
+        npoints      : number of r values
+        delta, omega : coefficients of hamiltonian_radial() with n=3
+        refine       : fraction of the points packed around the separatrix, 0 for a plain log spaced axis
+
+    Returns
+    -------
+        r : ascending radial axis. With refine the band from half the smallest to twice the largest r
+            of the separatrix gets refine*npoints points, the far field keeps the rest.
+    '''
+    npoints = int(npoints)
+    u_fp, phi_fp, h_sep = unstable_fixed_point(delta, omega)
+    if refine <= 0 or np.isnan(u_fp):
+        return 10**np.linspace(Rmin, Rmax, npoints)
+
+    u = radial_level(delta, omega, h_sep, np.linspace(-np.pi, np.pi, 361))[:, 0]
+    band = np.clip(np.log10([np.nanmin(u)**2/2, np.nanmax(u)**2*2]), Rmin, Rmax)
+    nband = int(refine*npoints)
+    r = np.union1d(np.linspace(Rmin, Rmax, npoints - nband), np.linspace(band[0], band[1], nband))
+    return 10**r
+
+def hamiltonian_grid(r, phi, nu, dnu, delta, omega, mux, alpha, beta, output, dtype=np.float64, memory=GRID_MEMORY):
+    '''
+    Evaluates the Hamiltonian on the phi x r grid and maps it to (x, px), a block of phi rows at a time,
+    so only the three results are held at full size and the temporaries stay within memory bytes.
+
+    Returns
+    -------
+        xx, xpxp, hh : len(phi) x len(r) arrays of dtype
+    '''
+    xx, xpxp, hh = [np.empty((len(phi), len(r)), dtype=dtype) for i in range(3)]
+    rows = max(1, int(memory // (len(r)*8*8)))            # About 8 float64 temporaries per point
+    for a in range(0, len(phi), rows):
+        rr, phiphi = np.meshgrid(r, phi[a:a+rows])
+        h = hamiltonian_radial(rr, phiphi, delta, omega, 3)
+
+        jj = rr*J0
+        phiphi, hh[a:a+rows] = phi1_to_phi(jj, phiphi, h, nu, dnu, mux)
+        ww, wdotwdot = j_to_w(jj, phiphi, nu)
+
+        xx[a:a+rows], xpxp[a:a+rows] = w_to_x(ww, wdotwdot, nu, alpha, beta, output)
+    return xx, xpxp, hh
+
+def HamiltonianContour(tdf, nu, nu_res, ele, Rmin, Rmax, ncount, output, title='', strengths=None,
+                       dtype=np.float64, refine=0, memory=GRID_MEMORY):
+    '''
+    Hamiltonian on an ncount x ncount (phi x r) grid at ele, for contouring.
+    dtype=np.float32 halves the memory of the grid, refine packs part of the r values around the
+    separatrix (see radial_axis()), memory bounds the temporaries of the evaluation.
+    '''
     # Compute contours
     dnu = nu - nu_res
     npoints = ncount
-    j0 = 0.0002
+    j0 = J0
 
     try:
-        beta = tdf.loc[ele]['betx']
-        alpha = tdf.loc[ele]['alfx']
-        mux_seh = 2*np.pi*tdf.loc[ele]['mux']
+        beta, alpha, mux_seh = get_optics(tdf, ele)
+        mux_seh = 2*np.pi*mux_seh
         output.clear_output()
     except KeyError:
-        with output:
-            output.clear_output()
-            CRED = '\033[91m'
-            CEND = '\033[0m'
-            print(CRED + f'ERROR : Element {ele} not found in lattice.' + CEND)
+        element_error(output, ele)
         return([0, 0], [0, 0], [[0, 0], [0, 0]]) #Empty contour plot
     
-    p3rtilde, mux_sext = get_p3rtilde(tdf, nu)
-    p40tilde = get_p40tilde(tdf, nu)
+    if strengths is None:
+        strengths = virtual_strengths(tdf, nu)
+    p3rtilde, mux_sext, p40tilde = strengths
+
+    mux = -(mux_seh - mux_sext)
+
+    factor = OCTUPOLE_FACTOR
+    delta, omega = get_delta_omega(dnu, factor*p40tilde, p3rtilde, j0, n=3)
+
+    r = radial_axis(Rmin, Rmax, npoints, delta, omega, refine)
+    phi = np.linspace(-np.pi, np.pi, int(npoints))
+    
+    return hamiltonian_grid(r, phi, nu, dnu, delta, omega, mux, alpha, beta, output, dtype, memory)
+
+def positive_roots(coeffs):
+    '''
+    Inputs
+    -------
+        coeffs : n x (d+1) array of polynomial coefficients, highest power first, leading column non-zero
+
+    Solves all n polynomials at once from the eigenvalues of their companion matrices.
+
+    Returns
+    -------
+        roots : n x d array of the positive real roots of each polynomial, ascending and padded with nan
+    '''
+    n, d = coeffs.shape[0], coeffs.shape[1] - 1
+    companion = np.zeros((n, d, d))
+    companion[:, 1:, :-1] = np.eye(d - 1)
+    companion[:, :, -1] = -coeffs[:, :0:-1]/coeffs[:, :1]
+    roots = np.linalg.eigvals(companion)
+    scale = np.abs(roots).max(axis=1, keepdims=True) + 1e-300
+    real = (np.abs(roots.imag) < 1e-6*scale) & (roots.real > 0)     # Double roots come out with a tiny imaginary part
+    return np.sort(np.where(real, roots.real, np.nan), axis=1)
+
+def radial_level(delta, omega, h, phi):
+    '''
+    Inputs
+    -------
+        delta, omega : coefficients of hamiltonian_radial() with n=3
+        h            : value of the Hamiltonian
+        phi          : angles, all inputs broadcast against each other
+
+    In u = sqrt(r) the Hamiltonian is the polynomial omega u^4 + cos(3 phi) u^3 + delta u^2,
+    so the level set h is found from its roots at every angle.
+
+    Returns
+    -------
+        u : broadcast shape x 4 array of the positive solutions u, ascending and padded with nan
+    '''
+    delta, omega, h, phi = np.broadcast_arrays(delta, omega, h, phi)
+    coeffs = np.stack([omega, np.cos(3*phi), delta, 0*phi, -h], axis=-1).reshape(-1, 5).astype(float)
+    if np.all(omega == 0):
+        u = np.pad(positive_roots(coeffs[:, 1:]), ((0, 0), (0, 1)), constant_values=np.nan)
+    else:
+        u = positive_roots(coeffs)
+    return u.reshape(phi.shape + (4,))
+
+def unstable_fixed_point(delta, omega):
+    '''
+    Innermost unstable fixed point of hamiltonian_radial() with n=3, for scalars or arrays of delta and omega.
+    Fixed points away from the origin lie where cos(3 phi) = c = +-1 and solve 4 omega u^2 + 3 c u + 2 delta = 0,
+    they are unstable where the curvatures along u and along phi have opposite signs.
 
+    Returns
+    -------
+        u, phi, h : position u = sqrt(r), angle and value of the Hamiltonian, nan without an unstable fixed point
+    '''
+    delta, omega = np.broadcast_arrays(np.asarray(delta, dtype=float), np.asarray(omega, dtype=float))
+    candidates = []
+    with np.errstate(all='ignore'):
+        root = np.sqrt(9 - 32*omega*delta)
+        for c, phi in [(1, 0), (-1, np.pi/3)]:
+            for u in [np.where(omega == 0, -2*delta/(3*c), (-3*c + root)/(8*omega)),
+                      np.where(omega == 0, np.nan, (-3*c - root)/(8*omega))]:
+                h_uu = 2*delta + 12*omega*u**2 + 6*c*u     # Curvature along u
+                h_phiphi = -9*c*u**3                       # Curvature along phi
+                unstable = (u > 0) & (h_uu*h_phiphi < 0)
+                candidates.append((np.where(unstable, u, np.inf), phi, c))
+
+    u = np.stack([cand[0] for cand in candidates])
+    best = np.argmin(u, axis=0)
+    u = np.take_along_axis(u, best[None], axis=0)[0]
+    c = np.array([cand[2] for cand in candidates])[best]
+    phi = np.array([cand[1] for cand in candidates])[best]
+    u = np.where(np.isinf(u), np.nan, u)
+    return u, np.where(np.isnan(u), np.nan, phi), delta*u**2 + omega*u**4 + c*u**3
+
+def HamiltonianSeparatrix(tdf, nu, nu_res, ele, output, levels=(0.25, 0.5, 0.75), Rmax=0.5, npoints=721, strengths=None):
+    '''
+    Inputs
+    -------
+        tdf     : twiss dataframe
+        nu      : horizontal tune
+        nu_res  : resonant tune
+        ele     : element where the phase space is drawn
+        output  : widget output for errors
+        levels  : invariant curves to trace, as fractions of the separatrix value of the Hamiltonian
+        Rmax    : arms are traced out to r = 10^Rmax, as in HamiltonianContour()
+        npoints : number of angles the curves are sampled at
+
+    Solves for the unstable fixed points of the Kobayashi Hamiltonian and traces the separatrix
+    and the chosen invariant curves directly, instead of contouring a grid.
+
+    Returns
+    -------
+        sep : dictionary with, in x [m] and px at ele,
+              x, px                : closed boundary of the stable triangle
+              arms_x, arms_px      : outer branches of the separatrix, one column per branch
+              curves_x, curves_px  : invariant curves, one column per level
+              fixed_x, fixed_px    : unstable fixed points
+              area                 : area of the stable triangle [m rad]
+              or None if ele is not in the lattice
+    '''
+    dnu = nu - nu_res
+    try:
+        beta, alpha, mux_seh = get_optics(tdf, ele)
+        mux_seh = 2*np.pi*mux_seh
+        output.clear_output()
+    except KeyError:
+        element_error(output, ele)
+        return None
+
+    if strengths is None:
+        strengths = virtual_strengths(tdf, nu)
+    p3rtilde, mux_sext, p40tilde = strengths
     mux = -(mux_seh - mux_sext)
+    delta, omega = get_delta_omega(dnu, OCTUPOLE_FACTOR*p40tilde, p3rtilde, J0, n=3)
+
+    def to_x(u, phi1):
+        jj = u**2*J0
+        phi, _ = phi1_to_phi(jj, phi1, 0, nu, dnu, mux)
+        ww, wdotwdot = j_to_w(jj, phi, nu)
+        return w_to_x(ww, wdotwdot, nu, alpha, beta, output)
 
-    #r = np.linspace(0, 4, npoints)
-    r = 10**np.linspace(Rmin, Rmax, int(npoints))
     phi = np.linspace(-np.pi, np.pi, int(npoints))
-    rr, phiphi = np.meshgrid(r, phi)
+    empty = np.full((len(phi), 1), np.nan)
+    sep = {'x': empty[:, 0], 'px': empty[:, 0], 'arms_x': empty, 'arms_px': empty,
+           'curves_x': empty, 'curves_px': empty, 'fixed_x': np.array([]), 'fixed_px': np.array([]), 'area': np.nan}
 
-    factor = 1.2
-    delta, omega = get_delta_omega(dnu, factor*p40tilde, p3rtilde, j0, n=3)
-    hh = hamiltonian_radial(rr, phiphi, delta, omega, 3)
+    u_fp, phi_fp, h_sep = unstable_fixed_point(delta, omega)
+    if np.isnan(u_fp):                                       # No resonance, no separatrix
+        return sep
 
-    jj = rr*j0
-    phiphi, hh = phi1_to_phi(jj, phiphi, hh, nu, dnu, mux)
-    ww, wdotwdot = j_to_w(jj, phiphi, nu)
+    u = radial_level(delta, omega, h_sep, phi)
+    arms = np.where(u[:, 1:] > np.sqrt(10**Rmax), np.nan, u[:, 1:])
+    sep['x'], sep['px'] = to_x(u[:, 0], phi)
+    sep['arms_x'], sep['arms_px'] = to_x(arms, phi[:, None])
+    sep['area'] = 0.5*np.abs(np.nansum(sep['x'][:-1]*sep['px'][1:] - sep['x'][1:]*sep['px'][:-1]))
 
-    xx, xpxp = w_to_x(ww, wdotwdot, nu, alpha, beta, output)
+    if len(levels):
+        u_levels = np.stack([radial_level(delta, omega, level*h_sep, phi)[:, 0] for level in levels], axis=1)
+        sep['curves_x'], sep['curves_px'] = to_x(u_levels, phi[:, None])
 
-    # Get contours in increasing order (the stable region is a valley)
-    flat_h = hh.flatten()
-    sorted_h = np.unique(np.sort(flat_h))
-    size = sorted_h.shape[0]
-    step = int(size/50)
-    
-    return(xx, xpxp, hh)
+    phi_fp = phi_fp + 2*np.pi/3*np.arange(3)               # The three fixed points of the triangle
+    sep['fixed_x'], sep['fixed_px'] = to_x(u_fp*np.ones(3), phi_fp)
+    return sep
+
+def separatrix_crossings(x, px, x_es):
+    '''
+    Inputs
+    -------
+        x, px : separatrix branches from HamiltonianSeparatrix(), one column per branch
+        x_es  : position of the electrostatic septum [m]
+
+    Returns
+    -------
+        px_es : angles at which the separatrix crosses x = x_es
+    '''
+    x, px = np.reshape(x, (len(x), -1)), np.reshape(px, (len(px), -1))
+    d = x - x_es
+    cross = (d[:-1]*d[1:] <= 0) & (d[:-1] != d[1:])          # nan compares False, so gaps never cross
+    i, k = np.nonzero(cross)
+    t = d[i, k]/(d[i, k] - d[i+1, k])
+    return np.sort(px[i, k] + t*(px[i+1, k] - px[i, k]))
+
+def resonance_flow(q, p, delta, omega, tau, substeps=32):
+    '''
+    Inputs
+    -------
+        q, p         : canonical coordinates q = sqrt(2r) cos(phi), p = -sqrt(2r) sin(phi)
+        delta, omega : coefficients of hamiltonian_radial() with n=3
+        tau          : time to integrate for, in the units of hamiltonian_radial()
+        substeps     : number of Runge-Kutta steps
+
+    Moves points along the flow of the radial Hamiltonian, all inputs broadcast against each other.
+
+    Returns
+    -------
+        q, p : coordinates after tau
+    '''
+    def velocity(q, p):
+        rr = q**2 + p**2
+        return (delta*p + omega*rr*p - 6*q*p/2**(3/2),
+                -(delta*q + omega*rr*q + 3*(q**2 - p**2)/2**(3/2)))
+    dt = tau/substeps
+    for step in range(substeps):
+        k1 = velocity(q, p)
+        k2 = velocity(q + dt/2*k1[0], p + dt/2*k1[1])
+        k3 = velocity(q + dt/2*k2[0], p + dt/2*k2[1])
+        k4 = velocity(q + dt*k3[0], p + dt*k3[1])
+        q = q + dt/6*(k1[0] + 2*k2[0] + 2*k3[0] + k4[0])
+        p = p + dt/6*(k1[1] + 2*k2[1] + 2*k3[1] + k4[1])
+    return q, p
+
+def tune_sweep(tdf, tunes, nu_res, ele, x_es, dpp=0, chroma=0, npoints=361):
+    '''
+    Inputs
+    -------
+        tdf     : twiss dataframe
+        tunes   : array of horizontal tunes
+        nu_res  : resonant tune
+        ele     : element of the electrostatic septum
+        x_es    : position of the septum [m]
+        dpp     : optional momentum offsets, broadcast against tunes
+        chroma  : chromaticity, the tune of a particle is tunes + chroma*dpp
+        npoints : number of angles the separatrices are sampled at
+
+    Evaluates the separatrix of every tune at once, as HamiltonianSeparatrix() does for one.
+    The spiral step is the change of x over three turns, moving along the flow of the Hamiltonian,
+    of a particle crossing x_es on the outgoing separatrix arm nearest to the stable triangle.
+
+    Returns
+    -------
+        sweep : dictionary of arrays shaped like tunes and dpp broadcast, nan where undefined
+                tune  : tune of each particle
+                area  : stable triangle area [m rad]
+                x_sep : unstable fixed point nearest the septum, x at ele [m]
+                px_es : px' where the outgoing separatrix crosses x_es
+                step  : spiral step at x_es [m]
+                kick  : spiral kick at x_es
+    '''
+    tunes, dpp = np.broadcast_arrays(np.asarray(tunes, dtype=float), np.asarray(dpp, dtype=float))
+    shape = tunes.shape
+    nu, dpp = (tunes + chroma*dpp).ravel(), dpp.ravel()
+    dnu = nu - nu_res
+    m = len(nu)
+
+    beta, alpha, mux_seh = get_optics(tdf, ele)
+    dx, dpx = lattice_sums(tdf)["dispersion"][ele]
+    p3rtilde, mux_sext, p40tilde = virtual_strengths(tdf, nu)
+    mux = np.broadcast_to(-(2*np.pi*mux_seh - mux_sext), nu.shape)
+    with np.errstate(all='ignore'):
+        delta, omega = get_delta_omega(dnu, OCTUPOLE_FACTOR*p40tilde, p3rtilde, J0, n=3)
+    sweep = {'tune': nu, 'area': np.full(m, np.nan), 'x_sep': np.full(m, np.nan), 'px_es': np.full(m, np.nan),
+             'step': np.full(m, np.nan), 'kick': np.full(m, np.nan)}
+    if not np.all(np.isfinite(delta)):                       # No sextupoles
+        return {key: value.reshape(shape) for key, value in sweep.items()}
+
+    def to_x(u, phi1, k):
+        'u, phi1 of the particles of tune number k to x, px at ele'
+        jj = u**2*J0
+        phi, _ = phi1_to_phi(jj, phi1, 0, nu[k], dnu[k], mux[k])
+        ww, wdotwdot = j_to_w(jj, phi, nu[k])
+        with np.errstate(all='ignore'):
+            x, px = w_to_x(ww, wdotwdot, nu[k], alpha, beta, None)
+        return x + dx*dpp[k], px + dpx*dpp[k]
+
+    u_fp, phi_fp, h_sep = unstable_fixed_point(delta, omega)
+    ok = np.flatnonzero(~np.isnan(u_fp))
+    phi = np.linspace(-np.pi, np.pi, int(npoints))
+    k = ok[:, None]
+
+    # Stable triangle and its fixed points
+    u = radial_level(delta[k], omega[k], h_sep[k], phi)
+    x, px = to_x(u[..., 0], phi, k)
+    sweep['area'][ok] = 0.5*np.abs(np.nansum(x[:, :-1]*px[:, 1:] - x[:, 1:]*px[:, :-1], axis=1))
+    fixed_x, _ = to_x(u_fp[k], phi_fp[k] + 2*np.pi/3*np.arange(3), k)
+    side = np.sign(x_es) if x_es != 0 else 1
+    sweep['x_sep'][ok] = side*np.max(side*fixed_x, axis=1)
+
+    # Crossings of the separatrix arms with the septum, for all tunes together
+    arms_x, arms_px = to_x(u[..., 1:], phi[:, None], k[..., None])
+    d = arms_x - x_es
+    i, j, b = np.nonzero((d[:, :-1]*d[:, 1:] <= 0) & (d[:, :-1] != d[:, 1:]))
+    t = d[i, j, b]/(d[i, j, b] - d[i, j+1, b])
+    u_c = u[i, j, b+1] + t*(u[i, j+1, b+1] - u[i, j, b+1])
+    phi_c = phi[j] + t*(phi[j+1] - phi[j])
+    px_c = arms_px[i, j, b] + t*(arms_px[i, j+1, b] - arms_px[i, j, b])
+    tune = ok[i]
+
+    # Three turns along the flow, a turn is 2 pi p3rtilde sqrt(J0) in the time of hamiltonian_radial()
+    q, p = np.sqrt(2)*u_c*np.cos(phi_c), -np.sqrt(2)*u_c*np.sin(phi_c)
+    with np.errstate(all='ignore'):                         # Arm points that diverge drop out below as non-finite
+        q, p = resonance_flow(q, p, delta[tune], omega[tune], 6*np.pi*p3rtilde[tune]*np.sqrt(J0))
+        x_3, px_3 = to_x(np.sqrt((q**2 + p**2)/2), np.arctan2(-p, q), tune)
+        step, kick = x_3 - x_es, px_3 - px_c
+    outgoing = np.flatnonzero(step*side > 0)
+    order = outgoing[np.lexsort((u_c[outgoing], tune[outgoing]))]
+    tune, first = np.unique(tune[order], return_index=True)
+    best = order[first]
+    sweep['px_es'][tune], sweep['step'][tune], sweep['kick'][tune] = px_c[best], step[best], kick[best]
+    return {key: value.reshape(shape) for key, value in sweep.items()}
+
+def SeparatrixRing(tdf, nu, nu_res, output, npoints=181, dtype=np.float32, memory=GRID_MEMORY, strengths=None):
+    '''
+    Inputs
+    -------
+        tdf     : twiss dataframe
+        nu      : horizontal tune
+        nu_res  : resonant tune
+        output  : widget output for errors
+        npoints : number of angles the separatrix is sampled at
+        dtype   : storage type of the curves
+        memory  : bytes of temporaries used at once, the elements are mapped in blocks
+
+    Solves the separatrix once in normalised coordinates and maps it to (x, px) at every element
+    of the twiss table, with w_to_x() over all betx, alfx and mux at once.
+
+    Returns
+    -------
+        ring : dictionary with
+               name, s              : element names and positions
+               x, px                : n_elements x npoints stable triangle at every element
+               fixed_x, fixed_px    : n_elements x 3 unstable fixed points
+               x_min, x_max         : envelope of the stable triangle along s
+               px_min, px_max       : same for px
+               area                 : stable triangle area [m rad], the same at every element
+               or None if there is no separatrix
+    '''
+    dnu = nu - nu_res
+    if strengths is None:
+        strengths = virtual_strengths(tdf, nu)
+    p3rtilde, mux_sext, p40tilde = strengths
+    delta, omega = get_delta_omega(dnu, OCTUPOLE_FACTOR*p40tilde, p3rtilde, J0, n=3)
+    u_fp, phi_fp, h_sep = unstable_fixed_point(delta, omega)
+    if np.isnan(u_fp):
+        return None
+
+    phi = np.linspace(-np.pi, np.pi, int(npoints))
+    jj = radial_level(delta, omega, h_sep, phi)[:, 0]**2*J0
+    phi = np.append(phi, phi_fp + 2*np.pi/3*np.arange(3))         # Fixed points are mapped as three extra angles
+    jj = np.append(jj, np.full(3, u_fp**2*J0))
+
+    beta = tdf['betx'].to_numpy(dtype=float)
+    alpha = tdf['alfx'].to_numpy(dtype=float)
+    mux = -(2*np.pi*tdf['mux'].to_numpy(dtype=float) - mux_sext)
+
+    x, px = [np.empty((len(tdf), len(phi)), dtype=dtype) for i in range(2)]
+    rows = max(1, int(memory // (len(phi)*8*6)))
+    for a in range(0, len(tdf), rows):
+        b = slice(a, a + rows)
+        phi_e, _ = phi1_to_phi(jj, phi, 0, nu, dnu, mux[b, None])
+        ww, wdotwdot = j_to_w(jj, phi_e, nu)
+        x[b], px[b] = w_to_x(ww, wdotwdot, nu, alpha[b, None], beta[b, None], output)
 
+    x, fixed_x, px, fixed_px = x[:, :-3], x[:, -3:], px[:, :-3], px[:, -3:]
+    return {'name': tdf.index.to_numpy(), 's': tdf['s'].to_numpy(dtype=float),
+            'x': x, 'px': px, 'fixed_x': fixed_x, 'fixed_px': fixed_px,
+            'x_min': x.min(axis=1), 'x_max': x.max(axis=1), 'px_min': px.min(axis=1), 'px_max': px.max(axis=1),
+            'area': 0.5*np.abs(np.sum(x[0, :-1].astype(float)*px[0, 1:] - x[0, 1:].astype(float)*px[0, :-1]))}
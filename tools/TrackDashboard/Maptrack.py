@@ -0,0 +1,124 @@
+import numpy as np
+from tqdm.notebook import tqdm
+
+RMATRIX = [f're{i}{j}' for i in range(1, 7) for j in range(1, 7)]
+TRACK_BUFFER = 2**27                                            # Bytes of turns gathered before writing to out
+
+def element_index(twiss, ele):
+    '''
+    Inputs
+    -------
+        twiss : MADX twiss dataframe, from maptrack_twiss_cached()
+        ele   : element name, '#start' or '#end'
+
+    Returns
+    -------
+        index : row number of the element in the twiss table
+    '''
+    if ele == '#start':
+        return 0
+    if ele == '#end':
+        return len(twiss) - 1
+    names = twiss['name'].str.split(':').str[0].str.lower()
+    rows = np.flatnonzero(names == ele.lower())
+    if len(rows) == 0:
+        raise KeyError(f'Element {ele} not found in lattice.')
+    return rows[0]
+
+def multipole_kick(coords, k2l, k3l):
+    '''
+    Inputs
+    -------
+        coords : 6 x Np array of X, PX, Y, PY, T, PT, updated in place
+        k2l    : integrated sextupole strength
+        k3l    : integrated octupole strength
+
+    Applies a thin normal sextupole and octupole kick to every particle.
+    '''
+    z = coords[0] + 1j*coords[2]
+    kick = -(k2l/2 * z**2 + k3l/6 * z**3)
+    coords[1] += kick.real
+    coords[3] -= kick.imag
+
+def lattice_maps(twiss, obs):
+    '''
+    Inputs
+    -------
+        twiss : line-mode MADX twiss dataframe with the rmatrix columns, from maptrack_twiss_cached()
+        obs   : row numbers of the observation points
+
+    Cuts the lattice at every sextupole, octupole and observation point.
+    The linear map between two cuts is R_b R_a^-1, where R is the rmatrix from the start of the
+    lattice to each element. All the elements between two cuts are therefore tracked with a single
+    matrix product. A periodic twiss holds the one-turn map at each element instead, which is
+    rejected since R at the start is then not the identity.
+
+    Returns
+    -------
+        cuts : row numbers of the cuts
+        maps : transfer matrix from the previous cut to each cut, plus one to the end of the lattice
+        k2l  : sextupole strength at each cut
+        k3l  : octupole strength at each cut
+    '''
+    R = twiss[RMATRIX].to_numpy(dtype=float).reshape(-1, 6, 6)
+    if not np.allclose(R[0], np.eye(6)):
+        raise ValueError('The rmatrix at the start is not the identity, use a line-mode twiss from maptrack_twiss_cached()')
+    k2l = twiss['k2l'].to_numpy(dtype=float)
+    k3l = twiss['k3l'].to_numpy(dtype=float)
+
+    cuts = np.union1d(np.flatnonzero((k2l != 0) | (k3l != 0)), obs)
+    ends = np.append(cuts, len(twiss) - 1)
+
+    maps = [R[ends[0]]]
+    for a, b in zip(ends[:-1], ends[1:]):
+        maps.append(np.linalg.solve(R[a].T, R[b].T).T)
+    return cuts, np.array(maps), k2l[cuts], k3l[cuts]
+
+def maptrack(twiss, Beams, nturns, obs='#end', out=None, memory=TRACK_BUFFER):
+    '''
+    Inputs
+    -------
+        twiss  : line-mode MADX twiss dataframe, from maptrack_twiss_cached()
+        Beams  : particle coordinates from make_beam_dist()
+        nturns : number of turns to track
+        obs    : element, or list of elements, where the coordinates are recorded
+        out    : optional preallocated output array, e.g. a np.memmap
+        memory : bytes of the buffer of turns
+
+    Tracks all particles at once with the linear transfer maps of the lattice and
+    thin sextupole and octupole kicks from k2l and k3l.
+    Turns are gathered in a buffer and written to out a block of turns at a time, so a turn-last
+    memory-mapped out is written in contiguous runs rather than one column per turn.
+
+    Returns
+    -------
+        out : X, PX, Y, PY, T, PT at obs in a 6 x Np x nturns array,
+              or n_obs x 6 x Np x nturns if obs is a list
+    '''
+    Np, nturns = len(Beams[0]), int(nturns)
+    names = [obs] if isinstance(obs, str) else list(obs)
+    obs_rows = np.array([element_index(twiss, name) for name in names])
+    cuts, maps, k2l, k3l = lattice_maps(twiss, obs_rows)
+    record = [np.flatnonzero(obs_rows == cut) for cut in cuts]    # Observation points at each cut
+
+    coords = np.array([Beams[0], Beams[1], Beams[2], Beams[3], np.zeros(Np), Beams[5]], dtype=float)
+    if out is None:
+        out = np.zeros((len(names), 6, Np, nturns))
+        if isinstance(obs, str):
+            out = out[0]
+    out_obs = out[None] if isinstance(obs, str) else out
+    block = max(1, min(nturns, int(memory / (8 * 6 * Np * len(names)))))
+    buffer = np.zeros((len(names), 6, Np, block))
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        for turn in tqdm(range(nturns), desc='Maptrack'):
+            for n in range(len(cuts)):
+                coords = maps[n] @ coords
+                multipole_kick(coords, k2l[n], k3l[n])
+                for k in record[n]:
+                    buffer[k, :, :, turn % block] = coords
+            coords = maps[-1] @ coords
+            if (turn + 1) % block == 0 or turn == nturns - 1:
+                t0 = turn - turn % block
+                out_obs[..., t0:turn+1] = buffer[..., :turn+1-t0]
+    return out
@@ -4,10 +4,13 @@ import numpy as np
 import pandas as pd
 from tqdm.notebook import tqdm
 import io
-
-import base64
+import os
 
 from tools.helpers import *
+from tools.TrackDashboard.helpertrack import *
+from tools.TrackDashboard.Maptrack import maptrack
+from tools.TrackFile import write_trackfile, TrackFile
+from tools.TrackResults import publish, discard
 
 def TrackDashboard():
     '''
@@ -80,72 +83,50 @@ def TrackDashboard():
     
     '==================== MADX-PTC Set-up ============================='
     h2 = widgets.HTML("<h2>MADX Set-up</h2>")
-    programme = widgets.RadioButtons(options=['MADX-PTC'], description='Tracking Software:', style=style)
+    programme = widgets.RadioButtons(options=['MADX-PTC', 'Maptrack'], description='Tracking Software:', style=style)
     upload = widgets.FileUpload(accept='.seq', description='MADX .seq', multiple=False, style=style)
     sequence = widgets.Text(value='PIMMS', description='Seq name', layout=widgets.Layout(width='200px'))
     twissplot = widgets.Button(description="Plot Twiss")
     twisssave = widgets.Button(description="Save PTC.tfs")
     
     def FileUploader(change):
-        'Set up for MADX PTC or Maptrack tracking'
-        if programme.value == 'MADX-PTC':
-            upload.description = 'MADX .seq'
-        if programme.value == 'Maptrack':
-            upload.description='Maptrack .zip'
+        'Set up for MADX PTC or Maptrack tracking, Maptrack uses a line-mode MADX twiss of the same .seq'
+        upload.description = 'MADX .seq'
             
     def MADX_Track(change):
         'Changes if button pushed or file uploaded'
-        if programme.value == 'MADX-PTC':
+        if programme.value in ['MADX-PTC', 'Maptrack']:
             seq_file = io.BytesIO( upload.data[0] )
             seq = io.TextIOWrapper(seq_file, encoding='utf-8')
             seqfile = seq.read()
             
             '---Begin MADX---'            
-            madx.input(f'BEAM, PARTICLE=POSITRON, PC={p.value}, ex={ex.value*1E6}, ey={ey.value*1E6}, DELTAP={DPP.value};')
-            madx.input(seqfile)
-            madx.use(sequence.value)
-            twiss = madx.twiss(rmatrix=True).dframe()
-            
-            def twiss_plot_button(b):
-                with twissout:
-                    figT = plt.figure(figsize=(11, 5))
-                    figT.canvas.toolbar_position = 'bottom'
-                    plot_twiss(figT, twiss)
-
-            twissplot.on_click(twiss_plot_button)
+            lattice['beam'] = f'BEAM, PARTICLE=POSITRON, PC={p.value}, ex={ex.value*1E6}, ey={ey.value*1E6}, DELTAP={DPP.value};'
+            lattice['seq'] = seqfile
+            lattice['seqname'] = sequence.value
+            lattice['key'] = lattice_key(seqfile, sequence.value, lattice['beam'])
+            lattice['twiss'] = twiss_cached(madx, lattice)           # Only runs MADX for a new lattice
             
-            def twiss_save_button(b):            
-                madx.input('ptc_create_universe;')
-                madx.input('ptc_create_layout,model=2,method=6,nst=5, exact;')
-                madx.input(f'PTC_TWISS, icase=5, no=5, FILE="{sequence.value}_Twiss_sloexlab.tfs";')
-                madx.input('PTC_END;')
+    def twiss_plot_button(b):
+        with twissout:
+            figT = plt.figure(figsize=(11, 5))
+            figT.canvas.toolbar_position = 'bottom'
+            plot_twiss(figT, lattice['twiss'])
 
-                filename = f"{sequence.value}_Twiss_sloexlab.tfs"
-                
-                with open(filename, 'r') as TFS_Twiss:
-                    TFS = TFS_Twiss.read()
-
-                    b64 = base64.b64encode(TFS.encode())
-                    payload = b64.decode()
-                    html_buttons = '''<html>
-                                <head>
-                                <meta name="viewport" content="width=device-width, initial-scale=1">
-                                </head>
-                                <body>
-                                <a download="{filename}" href="data:text/csv;base64,{payload}" download>
-                                <button class="p-Widget jupyter-widgets jupyter-button widget-button mod-warning">Download File</button>
-                                </a>
-                                </body>
-                                </html>
-                                '''
-                    html_button = html_buttons.format(payload=payload,filename=filename)
-                    with twisssaveout:
-                        display(widgets.HTML(html_button))                    
+    twissplot.on_click(twiss_plot_button)
+    
+    def twiss_save_button(b):            
+        filename = ptc_twiss_cached(madx, lattice, f"{sequence.value}_Twiss_sloexlab.tfs")
+        
+        with twisssaveout:
+            twisssaveout.clear_output()
+            display(download_button(filename))
 
-            twisssave.on_click(twiss_save_button)
+    twisssave.on_click(twiss_save_button)
     
     from cpymad.madx import Madx
     madx = Madx()        
+    lattice = {}
     twissout = widgets.Output()
     twisssaveout = widgets.Output()
     programme.observe(FileUploader, 'value')
@@ -158,8 +139,10 @@ def TrackDashboard():
     htrack = widgets.HTML('<h2>Track Settings</h2>')
     nturns = widgets.FloatText(value=1000, description='No. Turns')
     trackobs = widgets.Text(value='[#start,ES]', description='Observe at:')
+    workers = widgets.BoundedIntText(value=1, min=1, max=os.cpu_count(), description='Workers')
     TRACK = widgets.Button(description='TRACK!')
-    DownloadAs = widgets.RadioButtons(options=['PTC Track (.txt)', 'Pandas (.csv)', 'Numpy Array (.npy)'])
+    DownloadAs = widgets.RadioButtons(options=['PTC Track (.txt)', 'Pandas (.csv)', 'Numpy Array (.npy)', 'Chunked Track (.npz)'])
+    arrays = ['Numpy Array (.npy)', 'Chunked Track (.npz)']
     trackout = widgets.Output()
     trackdownload = widgets.Output()
 
@@ -171,75 +154,74 @@ def TrackDashboard():
                   ex.value, ey.value)
         with trackout:
             for i in tqdm(range(1), desc='PTC Track Time'):
-                madx.input('ptc_create_universe;')
-                madx.input('ptc_create_layout,model=2,method=2,nst=5, exact;')
-                madx.input('PTC_ALIGN;')
-                for n in range(Np.value):
-                    madx.input(f'ptc_start, x = {Beams[0][n]}, px={Beams[1][n]}, y={Beams[2][n]}, py={Beams[3][n]}, t=0, pt={Beams[5][n]};')
-                obs_list = trackobs.value.strip('[]').split(',')
-                for obs in obs_list:
-                    madx.input(f'ptc_observe, place={obs};')
-                madx.input(f'''ptc_track, turns={nturns.value}, element_by_element=True, file="{sequence.value}_Track_sloexlab.txt", ONETABLE=True, icase=5;
-                ptc_track_end;
-                ptc_end;''')
+                obs_list = [obs.strip() for obs in trackobs.value.strip('[]').split(',')]
+                obs_names = obs_list + ['#end'] * ('#end' not in obs_list)    # PTC always records the end of the lattice
+                trackfile = f"{sequence.value}_Track_sloexlab.txt"
+                parallel = workers.value > 1 or programme.value == 'Maptrack'
+                if parallel and DownloadAs.value not in arrays:
+                    with trackdownload:
+                        print('Parallel tracking and Maptrack produce a Numpy array')
+                    DownloadAs.value = 'Numpy Array (.npy)'
+                npyfile = f"{sequence.value}_Track_sloexlab.npy"
+                npzfile = f"{sequence.value}_Track_sloexlab.npz"
+                result = f"{sequence.value} {programme.value}"
+                if DownloadAs.value in arrays:
+                    # A new track replaces the last result of this lattice and programme
+                    discard(result)
+                    for old in [npyfile, npzfile]:
+                        if os.path.exists(old):
+                            os.remove(old)      # Unlinked rather than overwritten, so arrays and TrackFiles still reading it stay valid
+                if parallel:
+                    # Tracked straight into the .npy file on disk, the result never has to fit in memory
+                    data_arr = np.lib.format.open_memmap(npyfile, mode='w+', shape=(len(obs_names), 6, Np.value, int(nturns.value)))
+                    if programme.value == 'Maptrack':
+                        maptrack(maptrack_twiss_cached(madx, lattice), Beams, nturns.value, obs_names, out=data_arr)
+                    else:
+                        ptc_track_sharded(lattice['seq'], sequence.value, lattice['beam'], Beams,
+                                          int(nturns.value), obs_list, trackfile, workers.value, obs_names, out=data_arr)
+                    data_arr.flush()
+                else:
+                    load_lattice(madx, lattice)
+                    ptc_track(madx, Beams, nturns.value, obs_list, trackfile)
                 with trackdownload:
                     trackdownload.clear_output()
                     print('Converting file....')
                 if DownloadAs.value == 'PTC Track (.txt)':
                     filename =f"{sequence.value}_Track_sloexlab.txtone"
-                    readtype = 'r'
                 if DownloadAs.value == 'Pandas (.csv)':
                     pddata = pd.read_csv(f"{sequence.value}_Track_sloexlab.txtone", delim_whitespace=True, names=['Number', 'Turn', 'X', 'PX', 'Y', 'PY', 'T', 'PT', 'S', 'E'], header = 6, skiprows=2)
                     pddata = pddata[pddata.Number != '#segment'].astype(float)
                     filename = f"{sequence.value}_Track_sloexlab.csv"
                     pddata.to_csv(filename)
-                    readtype = 'r'
-                if DownloadAs.value == 'Numpy Array (.npy)':
-                    pddata = pd.read_csv(f"{sequence.value}_Track_sloexlab.txtone", delim_whitespace=True, names=['Number',  'Turn', 'X', 'PX', 'Y', 'PY', 'T', 'PT', 'S', 'E'], header = 6, skiprows=2)
-                    pddata = pddata[pddata.Number != '#segment'].astype(float)
-
-                    ES_pddata = pddata[pddata.S == pddata.S.unique()[1]] #Change this for custom element measurement
-                    pdtoarr = ES_pddata.drop(['Number', 'Turn', 'S', 'E'], axis=1)
-                    arr = np.array(pdtoarr)
-                    arr_shape = np.reshape(arr, (int(Np.value), int(nturns.value), 6))
-                    arr_swap = np.swapaxes(arr_shape, 0, 1)
-                    data_arr  = np.swapaxes(arr_swap, 0, 2)
-                    
-                    filename = f"{sequence.value}_Track_sloexlab.npy"
-                    np.save(filename, data_arr)
-                    readtype = 'rb'
+                if DownloadAs.value in arrays:
+                    filename = npyfile
+                    if not parallel:
+                        # Parses every observation point of the PTC table straight into the .npy file on disk
+                        data_arr = np.lib.format.open_memmap(filename, mode='w+', shape=(len(obs_names), 6, Np.value, int(nturns.value)))
+                        read_txtone(f"{sequence.value}_Track_sloexlab.txtone", Np.value, nturns.value, obs=obs_names, out=data_arr)
+                        data_arr.flush()
+                if DownloadAs.value == 'Chunked Track (.npz)':
+                    meta = {'sequence': sequence.value, 'programme': programme.value, 'observation_points': obs_names,
+                            'beam': dict(zip(['m', 'p', 'Np', 'DPP', 'betx', 'alfx', 'dx', 'dpx', 'ex', 'bety', 'alfy', 'dy', 'dpy', 'ey'],
+                                             [param.value for param in [m, p] + beam_params]))}
+                    npyfile, filename = filename, write_trackfile(npzfile, data_arr, meta)
+                    if isinstance(data_arr, np.memmap):
+                        del data_arr
+                        os.remove(npyfile)
+                    data_arr = TrackFile(filename)
+                if DownloadAs.value in arrays:
+                    # Hands the array to the Visualiser tab by reference
+                    publish(result, data_arr, {'observation_points': obs_names})
                 
                 with trackdownload:
                     trackdownload.clear_output()
-                    print('Downloading....')
-                    
-                with open(filename, readtype) as PTC_Track:
-                    PTC = PTC_Track.read()
-
-                    if DownloadAs.value == 'PTC Track (.txt)' or DownloadAs.value == 'Pandas (.csv)':
-                        b64 = base64.b64encode(PTC.encode())
-                    if DownloadAs.value == 'Numpy Array (.npy)':
-                        b64 = base64.b64encode(PTC)
-                    payload = b64.decode()
-                    html_buttons = '''<html>
-                                <head>
-                                <meta name="viewport" content="width=device-width, initial-scale=1">
-                                </head>
-                                <body>
-                                <a download="{filename}" href="data:text/csv;base64,{payload}" download>
-                                <button class="p-Widget jupyter-widgets jupyter-button widget-button mod-warning">Download File</button>
-                                </a>
-                                </body>
-                                </html>
-                                '''
-                    html_button = html_buttons.format(payload=payload,filename=filename)
-                    with trackdownload:
-                        trackdownload.clear_output()
-                        display(widgets.HTML(html_button))                    
+                    display(download_button(filename))
+                    if DownloadAs.value in arrays:
+                        print(f'Observation points : {obs_names}')
     
     with trackout:
         TRACK.on_click(PTCTrack)
-    trackwidgets = widgets.VBox([htrack, widgets.HBox([widgets.VBox([nturns, trackobs, DownloadAs, widgets.HBox([TRACK, trackdownload])]), trackout])])
+    trackwidgets = widgets.VBox([htrack, widgets.HBox([widgets.VBox([nturns, trackobs, workers, DownloadAs, widgets.HBox([TRACK, trackdownload])]), trackout])])
     
     Dashboard = widgets.VBox([widgets.HBox([PBeam, widgets.VBox([BeamGenPlot, BeamOut])]), widgets.HBox([prog, twissout]), trackwidgets])
     return(Dashboard)
\ No newline at end of file
@@ -0,0 +1,434 @@
+import numpy as np
+import pandas as pd
+import time
+import os
+import hashlib
+import io
+import itertools
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
+
+PTC_START = 'ptc_start, x=%.17g, px=%.17g, y=%.17g, py=%.17g, t=0, pt=%.17g;'
+TXTONE_COLUMNS = ['Number', 'Turn', 'X', 'PX', 'Y', 'PY', 'T', 'PT', 'S', 'E']
+
+twiss_cache = OrderedDict()     # lattice key -> MADX twiss dataframe
+ptc_twiss_files = {}            # PTC_TWISS file -> lattice key it was written for
+
+def lattice_key(seqfile, seqname, beam):
+    '''
+    Inputs
+    -------
+        seqfile : MADX sequence file contents
+        seqname : name of the sequence to use
+        beam    : MADX BEAM command, holding p, ex, ey and DPP
+
+    Returns
+    -------
+        key : hash of the sequence text with the sequence name and BEAM command
+    '''
+    return (hashlib.sha1(seqfile.encode()).hexdigest(), seqname, beam)
+
+def load_lattice(madx, lattice):
+    '''
+    Inputs
+    -------
+        madx    : cpymad Madx instance
+        lattice : dictionary with the 'seq' contents, 'seqname', 'beam' command and 'key'
+
+    Loads the BEAM and sequence into MADX, unless they are already the ones in use.
+    '''
+    if lattice.get('loaded') != lattice['key']:
+        madx.input(lattice['beam'])
+        madx.input(lattice['seq'])
+        madx.use(lattice['seqname'])
+        lattice['loaded'] = lattice['key']
+
+def twiss_cached(madx, lattice, maxsize=8):
+    '''
+    Inputs
+    -------
+        madx    : cpymad Madx instance
+        lattice : dictionary with the 'seq' contents, 'seqname', 'beam' command and 'key'
+        maxsize : number of twiss tables kept, the least recently used is dropped first
+
+    Returns
+    -------
+        twiss : madx.twiss(rmatrix=True).dframe(), only computed for lattices not seen recently
+    '''
+    key = lattice['key']
+    if key in twiss_cache:
+        twiss_cache.move_to_end(key)
+        return twiss_cache[key]
+    load_lattice(madx, lattice)
+    twiss_cache[key] = madx.twiss(rmatrix=True).dframe()
+    if len(twiss_cache) > maxsize:
+        twiss_cache.popitem(last=False)
+    return twiss_cache[key]
+
+def maptrack_twiss_cached(madx, lattice, maxsize=8):
+    '''
+    Inputs
+    -------
+        madx    : cpymad Madx instance
+        lattice : dictionary with the 'seq' contents, 'seqname', 'beam' command and 'key'
+        maxsize : number of twiss tables kept, the least recently used is dropped first
+
+    The rmatrix of a periodic twiss is the one-turn map at each element, which cannot be cut into
+    transfer maps. This twiss is run as a line from the periodic optics at the start instead, so its
+    rmatrix is the map from the start of the lattice to each element, as maptrack() needs, and
+    its optical functions are the same as those of the periodic twiss.
+
+    Returns
+    -------
+        twiss : line-mode madx.twiss(rmatrix=True).dframe(), only computed for lattices not seen recently
+    '''
+    key = ('line',) + tuple(lattice['key'])
+    if key in twiss_cache:
+        twiss_cache.move_to_end(key)
+        return twiss_cache[key]
+    start = twiss_cached(madx, lattice, maxsize).iloc[0]
+    load_lattice(madx, lattice)
+    initial = {name: float(start[name]) for name in ['betx', 'alfx', 'bety', 'alfy', 'dx', 'dpx', 'dy', 'dpy',
+                                                       'x', 'px', 'y', 'py']}
+    twiss_cache[key] = madx.twiss(rmatrix=True, **initial).dframe()
+    if len(twiss_cache) > maxsize:
+        twiss_cache.popitem(last=False)
+    return twiss_cache[key]
+
+def ptc_twiss_cached(madx, lattice, filename):
+    '''
+    Inputs
+    -------
+        madx     : cpymad Madx instance
+        lattice  : dictionary with the 'seq' contents, 'seqname', 'beam' command and 'key'
+        filename : PTC_TWISS output file
+
+    Runs PTC_TWISS into filename, unless the file was already written for this lattice.
+
+    Returns
+    -------
+        filename : PTC_TWISS output file
+    '''
+    if ptc_twiss_files.get(filename) == lattice['key'] and os.path.exists(filename):
+        return filename
+    load_lattice(madx, lattice)
+    madx.input('ptc_create_universe;')
+    madx.input('ptc_create_layout,model=2,method=6,nst=5, exact;')
+    madx.input(f'PTC_TWISS, icase=5, no=5, FILE="{filename}";')
+    madx.input('PTC_END;')
+    ptc_twiss_files[filename] = lattice['key']
+    return filename
+
+def ptc_start_loop(madx, Beams):
+    '''
+    Inputs
+    -------
+        madx  : cpymad Madx instance with a PTC layout already created
+        Beams : particle coordinates from make_beam_dist()
+
+    Original loading path: sends one ptc_start command to MADX per particle.
+    Kept as the reference for benchmark_ptc_start().
+    '''
+    for n in range(len(Beams[0])):
+        madx.input(f'ptc_start, x = {Beams[0][n]}, px={Beams[1][n]}, y={Beams[2][n]}, py={Beams[3][n]}, t=0, pt={Beams[5][n]};')
+
+def write_ptc_start(filename, Beams):
+    '''
+    Inputs
+    -------
+        filename : MADX script to write
+        Beams    : particle coordinates from make_beam_dist()
+
+    Writes the ptc_start statement of every particle into one MADX script.
+    The formatting is done by numpy in a single call rather than per particle.
+
+    Returns
+    -------
+        filename : name of the written script
+    '''
+    coords = np.column_stack([Beams[0], Beams[1], Beams[2], Beams[3], Beams[5]])
+    np.savetxt(filename, coords, fmt=PTC_START)
+    return filename
+
+def ptc_start_bulk(madx, Beams, filename='ptc_start_sloexlab.madx'):
+    '''
+    Inputs
+    -------
+        madx     : cpymad Madx instance with a PTC layout already created
+        Beams    : particle coordinates from make_beam_dist()
+        filename : MADX script the ptc_start statements are written to
+
+    Loads the whole beam into PTC with a single CALL, so only one command
+    is sent to the MADX process whatever the number of particles.
+    '''
+    write_ptc_start(filename, Beams)
+    madx.call(filename)
+
+def benchmark_ptc_start(madx, Beams, filename='ptc_start_sloexlab.madx'):
+    '''
+    Inputs
+    -------
+        madx     : cpymad Madx instance with a sequence in use
+        Beams    : particle coordinates from make_beam_dist()
+        filename : MADX script used by the bulk path
+
+    Times loading the same beam with ptc_start_loop() and ptc_start_bulk().
+    Each path is timed in its own PTC universe so the particle lists do not add up.
+
+    Returns
+    -------
+        times : dictionary of wall-clock times [s] for 'loop' and 'bulk'
+    '''
+    times = {}
+    loaders = {'loop': lambda: ptc_start_loop(madx, Beams),
+               'bulk': lambda: ptc_start_bulk(madx, Beams, filename)}
+    for name, load in loaders.items():
+        madx.input('ptc_create_universe;')
+        madx.input('ptc_create_layout,model=2,method=2,nst=5, exact;')
+        t0 = time.perf_counter()
+        load()
+        times[name] = time.perf_counter() - t0
+        madx.input('ptc_end;')
+    return times
+
+def ptc_track(madx, Beams, nturns, obs_list, filename):
+    '''
+    Inputs
+    -------
+        madx     : cpymad Madx instance with a sequence in use
+        Beams    : particle coordinates from make_beam_dist()
+        nturns   : number of turns to track
+        obs_list : list of observation points, e.g. ['#start', 'ES']
+        filename : PTC output name, PTC writes the table to filename+'one'
+
+    Builds the PTC layout, loads the beam and tracks it element by element.
+    '''
+    madx.input('ptc_create_universe;')
+    madx.input('ptc_create_layout,model=2,method=2,nst=5, exact;')
+    madx.input('PTC_ALIGN;')
+    ptc_start_bulk(madx, Beams, filename.rsplit('.', 1)[0] + '_start.madx')
+    for obs in obs_list:
+        madx.input(f'ptc_observe, place={obs};')
+    madx.input(f'''ptc_track, turns={nturns}, element_by_element=True, file="{filename}", ONETABLE=True, icase=5;
+    ptc_track_end;
+    ptc_end;''')
+
+def check_maptrack(madx, lattice, Beams, nturns, obs_list, filename='maptrack_check.txt'):
+    '''
+    Inputs
+    -------
+        madx     : cpymad Madx instance
+        lattice  : dictionary with the 'seq' contents, 'seqname', 'beam' command and 'key'
+        Beams    : particle coordinates from make_beam_dist(), a few particles are enough
+        nturns   : number of turns to track
+        obs_list : list of observation points, e.g. ['ES']
+        filename : PTC output name, removed afterwards
+
+    Tracks the same beam with maptrack() and ptc_track() and compares them at every observation point.
+    maptrack() uses thin multipole kicks, so a few percent over some tens of turns is expected.
+
+    Returns
+    -------
+        errors : dictionary of observation point -> largest difference in X and in PX,
+                 relative to the largest PTC value
+    '''
+    from tools.TrackDashboard.Maptrack import maptrack
+    load_lattice(madx, lattice)
+    ptc_track(madx, Beams, nturns, obs_list, filename)
+    try:
+        ptc = read_txtone(filename + 'one', len(Beams[0]), nturns, obs=list(obs_list))
+    finally:
+        for leftover in [filename + 'one', filename.rsplit('.', 1)[0] + '_start.madx']:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    mapped = maptrack(maptrack_twiss_cached(madx, lattice), Beams, nturns, list(obs_list))
+    return {obs: [np.max(np.abs(mapped[k, i] - ptc[k, i])) / np.max(np.abs(ptc[k, i])) for i in (0, 1)]
+            for k, obs in enumerate(obs_list)}
+
+def txtone_header(filename):
+    '''
+    Inputs
+    -------
+        filename : PTC .txtone tracking table
+
+    Reads the file up to the end of the first turn to find where the data starts
+    and which observation points were recorded.
+
+    Returns
+    -------
+        nheader   : number of @, * and $ header lines
+        observers : list of (element name, S) in the order PTC records them
+    '''
+    nheader, observers, name = 0, [], None
+    with open(filename, 'r') as datafile:
+        for line in datafile:
+            if line.startswith(('@', '*', '$')):
+                nheader += 1
+            elif line.startswith('#segment'):
+                name = line.split()[-1]
+            else:
+                fields = line.split()
+                turn = int(float(fields[1]))
+                if turn > 1:
+                    break
+                if turn == 1 and name not in [obs[0] for obs in observers]:
+                    observers.append((name, float(fields[8])))
+    return nheader, observers
+
+def read_txtone(filename, Np, nturns, obs=None, out=None, chunksize=10**6):
+    '''
+    Inputs
+    -------
+        filename  : PTC .txtone tracking table
+        Np        : number of tracked particles
+        nturns    : number of tracked turns
+        obs       : observation point, or list of observation points, to keep.
+                    Defaults to the first one after the start of the lattice
+        out       : optional preallocated output array, e.g. np.lib.format.open_memmap()
+        chunksize : number of rows parsed at a time
+
+    Streams the table in chunks and writes every record into out, at the observation point given by the
+    element name of its #segment line and at the particle and turn given by its Number and Turn columns.
+    The S of the records is checked against the observation point, elements at the same S stay apart.
+    The records of a chunk are gathered in a copy of the turns it covers, which is written back in one go,
+    so a turn-last memory-mapped out is written in contiguous runs.
+    All observation points are filled in the same pass. Peak memory is out plus about two chunks.
+    Lost particles keep zeros after their last turn.
+
+    Returns
+    -------
+        out : X, PX, Y, PY, T, PT in a 6 x Np x nturns array,
+              or n_obs x 6 x Np x nturns if obs is a list
+    '''
+    Np, nturns = int(Np), int(nturns)
+    nheader, observers = txtone_header(filename)
+    positions = {name.lower(): S for name, S in observers}
+    ends = {'#start': observers[0][0], '#end': observers[-1][0]}
+
+    if obs is None:
+        obs = [name for name, S in observers if S != observers[0][1]][0]
+    names = [obs] if isinstance(obs, str) else list(obs)
+    segments = [ends.get(name.lower(), name).lower() for name in names]      # #segment element names
+    S_obs = np.array([positions[segment] for segment in segments])
+    if out is None:
+        out = np.zeros((len(names), 6, Np, nturns))
+        if isinstance(obs, str):
+            out = out[0]
+    out_obs = out[None] if isinstance(obs, str) else out
+
+    with open(filename, 'rb') as datafile:
+        for _ in range(nheader):
+            datafile.readline()
+        current = None                                              # Segment the chunk starts in
+        while True:
+            text = b''.join(itertools.islice(datafile, chunksize))
+            if not text:
+                break
+            # #segment lines found on the raw bytes, pandas skips them as comments
+            raw = np.frombuffer(text, dtype=np.uint8)
+            line_starts = np.append(0, np.flatnonzero(raw[:-1] == ord('\n')) + 1)
+            line_ends = np.append(line_starts[1:], len(text))
+            is_segment = raw[line_starts] == ord('#')
+            starts = [current] + [text[i:j].split()[-1].decode().lower()
+                                  for i, j in zip(line_starts[is_segment], line_ends[is_segment])]
+            current = starts[-1]
+            # Observation rows of every segment of the chunk, and the segment of every record
+            rows = np.array([[start == segment for segment in segments] for start in starts])
+            seg = np.cumsum(is_segment)[~is_segment]
+            observed = rows[seg].any(axis=1)
+            if not observed.any():
+                continue
+            records = pd.read_csv(io.BytesIO(text), sep=r'\s+', comment='#', header=None, names=TXTONE_COLUMNS,
+                                  dtype=float).to_numpy()[observed]
+            seg = seg[observed]
+            number = records[:, 0].astype(int) - 1
+            turn = records[:, 1].astype(int) - 1
+            keep = (turn >= 0) & (turn < nturns) & (number < Np)
+            if not keep.any():
+                continue
+            t0, t1 = turn[keep].min(), turn[keep].max() + 1
+            block = np.array(out_obs[..., t0:t1])                   # Turns may be shared with the previous chunk
+            for k in range(len(names)):
+                at = keep & rows[seg, k]
+                if not np.allclose(records[at, 8], S_obs[k]):
+                    raise ValueError(f'Records of {names[k]} are not at its S = {S_obs[k]}')
+                block[k, :, number[at], turn[at] - t0] = records[at, 2:8]
+            out_obs[..., t0:t1] = block
+    return out
+
+def track_shard(seqfile, seqname, beam, Beams, nturns, obs_list, filename, obs=None, out=None):
+    '''
+    Inputs
+    -------
+        seqfile  : MADX sequence file contents
+        seqname  : name of the sequence to use
+        beam     : MADX BEAM command
+        Beams    : coordinates of the particles in this shard
+        nturns   : number of turns to track
+        obs_list : list of observation points
+        filename : PTC output name of this shard
+        obs      : observation point(s) to keep, see read_txtone()
+        out      : optional array the shard is written into
+
+    Tracks one shard of the beam in its own MADX process.
+    The shard's PTC table and start file are removed once they have been read into out.
+
+    Returns
+    -------
+        out : read_txtone() array of the shard
+    '''
+    from cpymad.madx import Madx
+    madx = Madx(stdout=False)
+    try:
+        madx.input(beam)
+        madx.input(seqfile)
+        madx.use(seqname)
+        ptc_track(madx, Beams, nturns, obs_list, filename)
+    finally:
+        madx.quit()
+    try:
+        return read_txtone(filename + 'one', len(Beams[0]), nturns, obs=obs, out=out)
+    finally:
+        for leftover in [filename + 'one', filename.rsplit('.', 1)[0] + '_start.madx']:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+def ptc_track_sharded(seqfile, seqname, beam, Beams, nturns, obs_list, filename, workers, obs=None, out=None):
+    '''
+    Inputs
+    -------
+        seqfile  : MADX sequence file contents
+        seqname  : name of the sequence to use
+        beam     : MADX BEAM command
+        Beams    : particle coordinates from make_beam_dist()
+        nturns   : number of turns to track
+        obs_list : list of observation points
+        filename : PTC output name, each shard appends _shard<k>
+        workers  : number of MADX processes tracking in parallel
+        obs      : observation point(s) to keep, see read_txtone()
+        out      : optional preallocated output array
+
+    Splits the beam into one shard per worker and tracks the shards in separate MADX processes.
+    Every cpymad Madx instance is its own process, so threads are enough to keep them all busy.
+    Each shard is parsed straight into its particle range of out, so the original order is kept.
+
+    Returns
+    -------
+        out : X, PX, Y, PY, T, PT in a 6 x Np x nturns array,
+              or n_obs x 6 x Np x nturns if obs is a list
+    '''
+    Np = len(Beams[0])
+    shards = np.array_split(np.arange(Np), min(workers, Np))
+    stem, ext = filename.rsplit('.', 1)
+
+    if out is None:
+        out = np.zeros((6, Np, int(nturns)) if isinstance(obs, str) or obs is None else (len(obs), 6, Np, int(nturns)))
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        futures = []
+        for k, idx in enumerate(shards):
+            shard_beam = [np.asarray(coord)[idx] if np.ndim(coord) else coord for coord in Beams]
+            futures.append(pool.submit(track_shard, seqfile, seqname, beam, shard_beam, nturns, obs_list,
+                                       f'{stem}_shard{k}.{ext}', obs, out[..., idx[0]:idx[-1]+1, :]))
+        [future.result() for future in futures]
+    return out
@@ -0,0 +1,132 @@
+import json
+import zipfile
+import numpy as np
+
+def write_trackfile(filename, data, meta={}, particle_block=256, turn_block=1024, shuffle=True, dtype=None):
+    '''
+    Inputs
+    -------
+        filename       : chunked track file to write, a zip archive of .npy blocks
+        data           : 6 x Np x nturns or n_obs x 6 x Np x nturns array, may be a np.memmap
+        meta           : dictionary of beam parameters, sequence name, observation points, ...
+        particle_block : number of particles per block
+        turn_block     : number of turns per block
+        shuffle        : groups the bytes of the floats before compressing, which compresses far better
+        dtype          : optional storage type, e.g. np.float32 halves the file
+
+    Cuts the track array into particle-blocks x turn-blocks and deflates each block separately,
+    so any range of turns and particles can later be read without decompressing the rest.
+    Blocks are written one at a time, memory use does not depend on the size of data.
+
+    Returns
+    -------
+        filename : name of the written file
+    '''
+    *lead, Np, nturns = np.shape(data)
+    dtype = np.dtype(data.dtype if dtype is None else dtype)
+    index = {'shape': np.shape(data), 'dtype': dtype.str, 'particle_block': particle_block,
+             'turn_block': turn_block, 'shuffle': shuffle, 'meta': meta}
+
+    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        zf.writestr('index.json', json.dumps(index))
+        for i, p0 in enumerate(range(0, Np, particle_block)):
+            for j, t0 in enumerate(range(0, nturns, turn_block)):
+                block = np.ascontiguousarray(data[..., p0:p0+particle_block, t0:t0+turn_block], dtype=dtype)
+                if shuffle:
+                    block = block.view(np.uint8).reshape(-1, block.itemsize).T
+                with zf.open(f'p{i}_t{j}.npy', 'w', force_zip64=True) as blockfile:
+                    np.lib.format.write_array(blockfile, np.ascontiguousarray(block))
+    return filename
+
+def index_bounds(key, n):
+    'First and last+1 position along an axis of length n selected by an integer, slice or index array'
+    if isinstance(key, slice):
+        positions = np.arange(n)[key]
+    else:
+        positions = np.asarray(key)
+        if np.any((positions >= n) | (positions < -n)):
+            raise IndexError(f'index out of range for axis of length {n}')
+        positions = positions % n
+    if positions.size == 0:
+        return 0, 0
+    return int(positions.min()), int(positions.max()) + 1
+
+def index_shift(key, n, offset):
+    'Re-expresses an integer, slice or index array along an axis of length n relative to offset'
+    if isinstance(key, slice):
+        positions = range(*key.indices(n))
+        if len(positions) == 0:
+            return slice(0, 0)
+        stop = positions[-1] - offset + (1 if positions.step > 0 else -1)
+        return slice(positions[0] - offset, stop if stop >= 0 else None, positions.step)
+    return np.asarray(key) % n - offset
+
+class TrackFile:
+    '''
+    Read access to a file made by write_trackfile().
+
+    Indexes like the track array it holds, e.g. tracks[0, :, 100:200] or tracks[1, p, turns],
+    but only the blocks covering the requested particles and turns are decompressed.
+    Indexing a n_obs x 6 x Np x nturns file with a single integer selects an observation point,
+    which returns another TrackFile and reads nothing.
+    '''
+    def __init__(self, filename, obs=None):
+        self.filename = filename
+        self.zf = filename.zf if isinstance(filename, TrackFile) else zipfile.ZipFile(filename)
+        self.index = json.loads(self.zf.read('index.json'))
+        self.meta = self.index['meta']
+        self.dtype = np.dtype(self.index['dtype'])
+        self.obs = obs
+        shape = tuple(self.index['shape'])
+        self.shape = shape if obs is None else shape[1:]
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def block(self, i, j):
+        'Decompresses block i along the particles and j along the turns'
+        block = np.lib.format.read_array(self.zf.open(f'p{i}_t{j}.npy'))
+        if self.index['shuffle']:
+            block = np.ascontiguousarray(block.T).view(self.dtype)
+        *lead, Np, nturns = self.index['shape']
+        pb, tb = self.index['particle_block'], self.index['turn_block']
+        block = block.reshape(*lead, min(pb, Np - i*pb), min(tb, nturns - j*tb))
+        return block if self.obs is None else block[self.obs]
+
+    def read(self, particles=slice(None), turns=slice(None)):
+        '''
+        Inputs
+        -------
+            particles : slice of particles to read
+            turns     : slice of turns to read
+
+        Returns
+        -------
+            data : track array restricted to the requested particles and turns
+        '''
+        *lead, Np, nturns = self.shape
+        pb, tb = self.index['particle_block'], self.index['turn_block']
+        p0, p1 = index_bounds(particles, Np)
+        t0, t1 = index_bounds(turns, nturns)
+
+        data = np.zeros((*lead, p1 - p0, t1 - t0), dtype=self.dtype)
+        for i in range(p0 // pb, -(-p1 // pb)):
+            for j in range(t0 // tb, -(-t1 // tb)):
+                block = self.block(i, j)
+                bp0, bt0 = max(p0, i*pb), max(t0, j*tb)
+                bp1, bt1 = min(p1, (i+1)*pb), min(t1, (j+1)*tb)
+                data[..., bp0-p0:bp1-p0, bt0-t0:bt1-t0] = block[..., bp0-i*pb:bp1-i*pb, bt0-j*tb:bt1-j*tb]
+        return data[..., index_shift(particles, Np, p0), :][..., index_shift(turns, nturns, t0)]
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        if self.ndim == 4 and len(key) == 1 and np.ndim(key[0]) == 0 and not isinstance(key[0], slice):
+            return TrackFile(self, obs=int(key[0]) % self.shape[0])
+        key = key + (slice(None),) * (self.ndim - len(key))
+        *lead, particles, turns = key
+        *_, Np, nturns = self.shape
+        p0, p1 = index_bounds(particles, Np)
+        t0, t1 = index_bounds(turns, nturns)
+        data = self.read(slice(p0, p1), slice(t0, t1))
+        return data[(*lead, index_shift(particles, Np, p0), index_shift(turns, nturns, t0))]
@@ -0,0 +1,26 @@
+# In-kernel registry of tracking results.
+# The Tracking Code tab publishes every finished track array here and the Visualiser
+# picks them up by reference, without saving, downloading or uploading them.
+
+results = {}        # name -> (track array, metadata)
+subscribers = []    # callbacks run with the name of every new result
+
+def publish(name, data, meta={}):
+    '''
+    Inputs
+    -------
+        name : label shown in the Visualiser
+        data : track array, np.memmap or TrackFile. Stored by reference, never copied
+        meta : dictionary of run information, e.g. observation_points
+    '''
+    results[name] = (data, meta)
+    for callback in subscribers:
+        callback(name)
+
+def subscribe(callback):
+    'Runs callback(name) every time a result is published'
+    subscribers.append(callback)
+
+def discard(name):
+    'Drops a result from the registry so its memory can be released'
+    results.pop(name, None)
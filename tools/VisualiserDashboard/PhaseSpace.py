@@ -6,6 +6,43 @@ import numpy as np
 from tqdm.notebook import tqdm
 import ipywidgets as widgets
 
+RASTER_POINTS = 10**5                                            # Plots with more points are rasterized, with smaller markers
+COLOUR_LEVELS = 256                                              # Most artists of a gradient plot
+
+def turn_values(data, name, T_arr, coord):
+    'Coordinate name, or the turn number for Turns, of every particle at the turns T_arr, as a len(T_arr) x Np array'
+    if name == 'Turns':
+        return np.broadcast_to(np.asarray(T_arr, dtype=float)[:, None], (len(T_arr), np.shape(data)[1]))
+    return np.asarray(data[coord[name], :, T_arr])
+
+def plot_turns(ax, x, y, T_arr, color=None, cmap=None, norm=None):
+    '''
+    Inputs
+    -------
+        ax     : matplotlib axis
+        x, y   : len(T_arr) x Np arrays from turn_values()
+        T_arr  : turn numbers
+        color  : colour of every point, when there is no cmap
+        cmap   : colour map of the turn number, with norm
+
+    Draws all points with one artist, or with a colour map in at most COLOUR_LEVELS artists of
+    consecutive turns, each coloured by its mean turn. Up to COLOUR_LEVELS turns every turn keeps its
+    own colour, and later turns are drawn on top as before. Per-point colours (a scatter) would take
+    ten times longer to draw than these marker lines.
+
+    Returns
+    -------
+        lines : the Line2D artists drawn
+    '''
+    style = {'rasterized': True, 'markersize': 2} if np.size(x) > RASTER_POINTS else {}
+    if cmap is None:
+        return ax.plot(np.ravel(x), np.ravel(y), '.', color=color, **style)
+    lines = []
+    if len(T_arr) == 0:
+        return lines
+    for group in np.array_split(np.arange(len(T_arr)), min(len(T_arr), COLOUR_LEVELS)):
+        lines += ax.plot(np.ravel(x[group]), np.ravel(y[group]), '.', color=cmap(norm(np.mean(T_arr[group]))), **style)
+    return lines
 
 def PhaseSpaceInputs(trackdata):
     ''''''
@@ -33,7 +70,7 @@ def PhaseSpaceInputs(trackdata):
     AnimateButton = widgets.Button(description='Animate', icon='photo-video')
     
     err_out = widgets.Output()
-    tqdm_out = widgets.Output()
+    colorbar = []
     
     AnimateDisplay = widgets.Output()
     Animate = widgets.HBox([AnimateButton, AnimateDisplay])
@@ -78,6 +115,8 @@ def PhaseSpaceInputs(trackdata):
         
         def plotphase(change):
             data = trackdata[0]
+            if colorbar:
+                colorbar.pop().remove()                          # Before clear, so axP gets its space back
             axP.clear()
             
             if XPlot.value == 'X' or XPlot.value == 'Y': 
@@ -91,8 +130,8 @@ def PhaseSpaceInputs(trackdata):
             
             if TurnType.value == 'Single Turn':
                 try:
-                    axP.plot(data[coord[XPlot.value], :, TurnNo.value],
-                             data[coord[YPlot.value] ,:, TurnNo.value], '.', color=Color.value)
+                    plot_turns(axP, data[coord[XPlot.value], :, TurnNo.value],
+                               data[coord[YPlot.value] ,:, TurnNo.value], [TurnNo.value], color=Color.value)
                     err_out.clear_output()
                     
                 except IndexError:
@@ -104,55 +143,25 @@ def PhaseSpaceInputs(trackdata):
                         
             if TurnType.value == 'Cumulative Turns':
                 T_arr = np.arange(TurnMin.value, TurnMax.value, TurnStep.value)
+                X = turn_values(data, XPlot.value, T_arr, coord)
+                Y = turn_values(data, YPlot.value, T_arr, coord)
                 
                 if Gradient.value == False:
-                    if XPlot.value != "Turns" and YPlot.value != "Turns":
-                        axP.plot(data[coord[XPlot.value], :, T_arr],
-                                 data[coord[YPlot.value] ,:, T_arr],
-                                 '.', color=Color.value)
-                    if XPlot.value == "Turns":
-                        for T in T_arr:
-                            axP.plot(T*np.ones(np.shape(data)[1]), data[coord[YPlot.value], :, T],
-                                    '.', color=Color.value)
-                    if YPlot.value == "Turns":
-                        for T in T_arr:
-                            axP.plot(data[coord[XPlot.value], :, T], T*np.ones(np.shape(data)[1]),
-                                    '.', color=Color.value)
-                    
+                    plot_turns(axP, X, Y, T_arr, color=Color.value)
                     
                 if Gradient.value == True:
                     cmap = matplotlib.colors.LinearSegmentedColormap.from_list("", [Color1.value, Color2.value])
                     NormT = Norm(TurnMin.value, TurnMax.value)
-                    plt.colorbar(cm.ScalarMappable(norm=NormT, cmap=cmap))
-                    if XPlot.value != "Turns" and YPlot.value != "Turns":
-                        with tqdm_out:
-                            tqdm_out.clear_output()
-                            for T in tqdm(T_arr):
-                                for p in range(np.shape(data)[1]):
-                                    axP.plot(data[coord[XPlot.value],  p, T],
-                                             data[coord[YPlot.value] , p, T],
-                                             '.', color=cmap(NormT(T)))
-                    if XPlot.value == "Turns":
-                        with tqdm_out:
-                            tqdm_out.clear_output()
-                            for T in tqdm(T_arr):
-                                for p in range(np.shape(data)[1]):
-                                    axP.plot(T, data[coord[YPlot.value], p, T],
-                                            '.', color=cmap(NormT(T)))
-                    if YPlot.value == "Turns":
-                        with tqdm_out:
-                            tqdm_out.clear_output()
-                            for T in tqdm(T_arr):
-                                for p in range(np.shape(data)[1]):
-                                    axP.plot(data[coord[XPlot.value], p, T], T,
-                                            '.', color=cmap(NormT(T)))                               
-                
+                    colorbar.append(plt.colorbar(cm.ScalarMappable(norm=NormT, cmap=cmap), ax=axP))
+                    plot_turns(axP, X, Y, T_arr, cmap=cmap, norm=NormT)
+                    
+            figP.canvas.draw_idle()
         
         PlotButton.on_click(plotphase)
         
         plt.show()
         
-    PhaseSpaceDash = widgets.VBox([widgets.HBox([Inputs, widgets.VBox([TurnDisplay, err_out]), Buttons]), tqdm_out, phase_output])
+    PhaseSpaceDash = widgets.VBox([widgets.HBox([Inputs, widgets.VBox([TurnDisplay, err_out]), Buttons]), phase_output])
     
     return PhaseSpaceDash
 
@@ -9,10 +9,27 @@ except:
     import PyNAFF
     os.chdir('/eos/home-r/retaylor/SWAN_projects/sloexlab/sloexlab')
 
-import base64
 from tqdm.notebook import tqdm
 
-from tools.VisualiserDashboard.TunePlot import TunePlotDash
+from tools.VisualiserDashboard.TunePlot import TunePlotDash, FrequencyMapPlot
+from tools.helpers import download_button
+from tools.TrackFile import TrackFile
+
+def naff_scroll(x_pos, turns, Q_step):
+    '''
+    x_pos  : n x T array of turn-by-turn positions of n particles
+    turns  : turn numbers at the end of each window
+    Q_step : number of turns per window
+
+    PyNAFF tune of every window, 0 where fewer than Q_step turns come before it
+    '''
+    Q = np.zeros((len(x_pos), len(turns)))
+    for p in range(len(x_pos)):
+        for t, Turn_no in enumerate(turns):
+            if Turn_no - Q_step > 0:
+                x_step = x_pos[p, Turn_no - Q_step : Turn_no]
+                Q[p,t] = PyNAFF.naff(x_step - np.mean(x_step), Q_step, 1, 0, False)[0][1]
+    return Q
 
 def tune_scroll(Tracks, n_particles, t_step, Q_step, param='X'):
     ''' 
@@ -23,17 +40,369 @@ def tune_scroll(Tracks, n_particles, t_step, Q_step, param='X'):
     coord = {'X': 0, 'Xp':1, 'Y':2, 'Yp':3}
     N_turns = np.shape(X_pos)[2]
     Q = np.zeros((2, n_particles, int(N_turns/t_step)))
+    Q[1] = np.arange(int(N_turns/t_step)) * t_step
     for p in tqdm(range(n_particles)):
-        x_pos = X_pos[coord[param], p, :]
-        for t in range(int(N_turns/t_step)):
-            Turn_no = t * t_step
-            if Turn_no - Q_step > 0:
-                x_step = x_pos[Turn_no - Q_step : Turn_no]
-                Q[0,p,t] = PyNAFF.naff(x_step - np.mean(x_step), Q_step, 1, 0, False)[0][1]
+        x_pos = np.asarray(X_pos[coord[param], p:p+1, :])      # One read per particle when X_pos is memory-mapped
+        Q[0,p] = naff_scroll(x_pos, Q[1,p].astype(int), Q_step)[0]
+    return Q
+
+TUNE_MEMORY = 2**27                                             # Bytes of window data held at once by tune_fft
+
+def phasors(tunes, N, block=16):
+    'exp(-2 pi i f n) for n < N and every tune f, as the product of the phasors of n % block and of the multiples of block'
+    fine = np.exp(-2j*np.pi*np.multiply.outer(tunes, np.arange(block)))
+    coarse = np.exp(-2j*np.pi*np.multiply.outer(tunes, np.arange(0, N, block)))
+    return (coarse[:, :, None] * fine[:, None, :]).reshape(len(tunes), -1)[:, :N]
+
+def peak_tunes(windows, iterations=2, amplitude=False):
+    '''
+    Inputs
+    -------
+        windows    : m x N array, one window of turn-by-turn positions per row
+        iterations : number of NAFF-like refinement steps after the FFT interpolation
+        amplitude  : also returns the amplitude of the line
+
+    Tune of the strongest line of every window, as PyNAFF.naff(..., 1, 0, False)[0][1].
+    The mean is removed and each row multiplied by a Hann window. The peak bin of the batched FFT is
+    interpolated from its neighbours (exact for a pure tone), then each step fits a parabola to
+    log|<x, exp(2 pi i f n)>| at f and f +- h, as NAFF does, with h shrinking tenfold each step.
+
+    Returns
+    -------
+        tunes      : m array, in [0, 0.5]
+        amplitudes : m array, only if amplitude, in the units of windows
+    '''
+    m, N = windows.shape
+    n = np.arange(N)
+    data = (windows - windows.mean(axis=1, keepdims=True)) * (1 - np.cos(2*np.pi*n/N))
+    spectrum = np.abs(np.fft.rfft(data, axis=1))
+    k = np.clip(np.argmax(spectrum[:, 1:], axis=1) + 1, 1, spectrum.shape[1] - 2)
+    rows = np.arange(m)
+    left, peak, right = spectrum[rows, k-1], spectrum[rows, k], spectrum[rows, k+1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        side = np.where(right > left, right, -left) / peak     # Signed ratio of the larger neighbour
+        offset = np.nan_to_num(np.sign(side) * (2*np.abs(side) - 1) / (np.abs(side) + 1))
+    tunes = (k + np.clip(offset, -1, 1)) / N
+
+    h = 0.1 / N
+    for _ in range(iterations):
+        phase = phasors(tunes, N) * data
+        shift = np.exp(-2j*np.pi*h*n)
+        a_minus = np.log(np.abs(phase @ np.conj(shift)) + 1E-300)
+        a_zero = np.log(np.abs(phase.sum(axis=1)) + 1E-300)
+        a_plus = np.log(np.abs(phase @ shift) + 1E-300)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.nan_to_num(0.5 * h * (a_minus - a_plus) / (a_minus - 2*a_zero + a_plus))
+        tunes = tunes + np.clip(step, -h, h)
+        h = h / 10
+    tunes = np.clip(tunes, 0, 0.5)
+    if amplitude:
+        return tunes, 2 / N * np.abs((phasors(tunes, N) * data).sum(axis=1))     # The Hann window sums to N
+    return tunes
+
+def fft_scroll(x_pos, turns, Q_step, iterations=2, memory=TUNE_MEMORY):
+    '''
+    As naff_scroll, with the windows of all particles stacked and passed to peak_tunes in chunks of memory bytes
+    '''
+    Q = np.zeros((len(x_pos), len(turns)))
+    full = np.flatnonzero(turns - Q_step > 0)                  # Windows with Q_step turns before them
+    if len(full) == 0:
+        return Q
+    windows = np.lib.stride_tricks.sliding_window_view(np.asarray(x_pos, dtype=np.float64), Q_step, axis=1)
+    starts = turns[full] - Q_step
+    chunk = max(1, int(memory / (16 * Q_step * len(x_pos))))  # Windows of every particle per call of peak_tunes
+    for w0 in range(0, len(full), chunk):
+        stack = windows[:, starts[w0:w0+chunk]].reshape(-1, Q_step)
+        Q[:, full[w0:w0+chunk]] = peak_tunes(stack, iterations).reshape(len(x_pos), -1)
+    return Q
+
+def tune_fft(Tracks, n_particles, t_step, Q_step, param='X', iterations=2, memory=TUNE_MEMORY):
+    '''
+    Inputs
+    -------
+        Tracks, n_particles, t_step, Q_step, param : as tune_scroll
+        iterations : refinement steps of peak_tunes
+        memory     : bytes of window data processed at once
+
+    Same result as tune_scroll, without calling PyNAFF per window. The windows of a block of particles
+    are cut from one read of their tracks and the tunes of all of them found by peak_tunes together.
+
+    Returns
+    -------
+        Q : 2 x n_particles x n_windows array of tunes and of the turn each window ends on
+    '''
+    X_pos = Tracks[0]
+    coord = {'X': 0, 'Xp':1, 'Y':2, 'Yp':3}
+    N_turns = np.shape(X_pos)[2]
+    turns = np.arange(int(N_turns/t_step)) * t_step
+    Q = np.zeros((2, n_particles, len(turns)))
+    Q[1] = turns
+    block = max(1, int(memory / (16 * Q_step * max(1, len(turns)))))   # Particles per read
+    for p0 in tqdm(range(0, n_particles, block)):
+        x_pos = X_pos[coord[param], p0:min(p0+block, n_particles), :]
+        Q[0, p0:p0+block] = fft_scroll(x_pos, turns, Q_step, iterations, memory)
+    return Q
+
+def dft_bins(spectrum, bins, N):
+    'Bins of any integer index of the DFT of real windows of length N, from their rfft spectrum'
+    bins = bins % N
+    mirror = bins > N // 2                                     # X[N-b] = conj(X[b]) for real data
+    rows = np.arange(len(spectrum))[:, None]
+    values = spectrum[rows, np.where(mirror, N - bins, bins)]
+    return np.where(mirror, np.conj(values), values)
+
+def sliding_scroll(x_pos, turns, Q_step, width=3):
+    '''
+    As fft_scroll, with each particle's spectrum updated as the window slides instead of recomputed.
+
+    Every particle keeps the unwindowed DFT bins k-width to k+width around the bin k of its peak. Moving
+    the window by s turns updates bin b with the s turns that leave and enter it,
+        X_b <- exp(2 pi i b s / N) (X_b + sum_n (x[m+N+n] - x[m+n]) exp(-2 pi i b n / N)),
+    so a step costs O(WindowStep) instead of O(WindowCalc log WindowCalc). The Hann window is applied to
+    the bins as X_b - (X_b-1 + X_b+1)/2, the mean is removed by leaving out bin 0, and the peak is
+    interpolated as in peak_tunes without the NAFF refinement. When the peak moves to a neighbouring bin
+    that particle's bins are recentred from one FFT of its current window.
+    '''
+    x_pos = np.asarray(x_pos, dtype=np.float64)
+    P, N = len(x_pos), Q_step
+    Q = np.zeros((P, len(turns)))
+    full = np.flatnonzero(turns - Q_step > 0)
+    if len(full) == 0 or N < 2*width + 2:
+        return Q
+    j = np.arange(-width, width + 1)
+    table = np.exp(-2j*np.pi*np.arange(N)/N)                   # exp(-2 pi i q / N), indexed by q mod N
+    rows = np.arange(P)
+
+    def recentre(k, m, sel):
+        'Bins around k of the windows starting at m, for the particles in sel'
+        spectrum = np.fft.rfft(x_pos[sel, m:m+N], axis=1)
+        return dft_bins(spectrum, k[sel, None] + j, N)
+
+    m = turns[full[0]] - N
+    hann = np.abs(np.fft.rfft(x_pos[:, m:m+N] * (1 - np.cos(2*np.pi*np.arange(N)/N)), axis=1))
+    k = np.clip(np.argmax(hann[:, 1:], axis=1) + 1, 1, N//2 - 1)
+    X = recentre(k, m, rows)
+    for t in full:
+        m_new = turns[t] - N
+        if m_new != m:
+            s = m_new - m
+            n = np.arange(s)
+            if s < N:
+                d = x_pos[:, m+N:m_new+N] - x_pos[:, m:m_new]
+                bins = k[:, None] + j
+                phase = table[(bins[:, :, None] * n) % N]          # P x (2 width + 1) x s
+                X = np.conj(table[(bins * s) % N]) * (X + np.einsum('ps,pbs->pb', d, phase))
+            else:
+                X = recentre(k, m_new, rows)
+            m = m_new
+
+        bins = k[:, None] + j
+        Xm = np.where(bins % N == 0, 0, X)                     # Mean removed
+        H = np.abs(Xm[:, 1:-1] - 0.5*(Xm[:, :-2] + Xm[:, 2:]))    # Hann windowed bins k-width+1 to k+width-1
+        c = width - 1                                          # Position of bin k in H
+        peak = np.argmax(H[:, c-1:c+2], axis=1) + c - 1
+        left, top, right = H[rows, peak-1], H[rows, peak], H[rows, peak+1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            side = np.where(right > left, right, -left) / top
+            offset = np.nan_to_num(np.sign(side) * (2*np.abs(side) - 1) / (np.abs(side) + 1))
+        Q[:, t] = np.clip((k + peak - c + np.clip(offset, -1, 1)) / N, 0, 0.5)
+
+        moved = np.flatnonzero((peak != c) & (k + peak - c >= 1) & (k + peak - c <= N//2 - 1))
+        if len(moved):
+            k[moved] += peak[moved] - c
+            X[moved] = recentre(k, m, moved)
+    return Q
+
+def tune_sliding(Tracks, n_particles, t_step, Q_step, param='X', memory=TUNE_MEMORY):
+    '''
+    Inputs
+    -------
+        Tracks, n_particles, t_step, Q_step, param : as tune_scroll
+        memory : bytes of tracks read at once
 
-            Q[1,p,t] = Turn_no
+    Same layout as tune_scroll, with sliding_scroll updating each particle's spectrum window to window.
+    Meant for WindowStep much smaller than WindowCalc, e.g. the tune of every 10 turns over a whole spill.
+
+    Returns
+    -------
+        Q : 2 x n_particles x n_windows array of tunes and of the turn each window ends on
+    '''
+    X_pos = Tracks[0]
+    coord = {'X': 0, 'Xp':1, 'Y':2, 'Yp':3}
+    N_turns = np.shape(X_pos)[2]
+    turns = np.arange(int(N_turns/t_step)) * t_step
+    Q = np.zeros((2, n_particles, len(turns)))
+    Q[1] = turns
+    block = max(1, int(memory / (8 * N_turns)))                # Particles per read
+    for p0 in tqdm(range(0, n_particles, block)):
+        x_pos = X_pos[coord[param], p0:min(p0+block, n_particles), :]
+        Q[0, p0:p0+block] = sliding_scroll(x_pos, turns, Q_step)
     return Q
 
+def frequency_map(Tracks, n_particles, Q_step, start=0, planes=('X', 'Y'), iterations=2, memory=TUNE_MEMORY):
+    '''
+    Inputs
+    -------
+        Tracks, n_particles, Q_step : as tune_scroll
+        start      : first turn of the first window
+        planes     : coordinates analysed, 'X' and/or 'Y'
+        iterations : refinement steps of peak_tunes
+        memory     : bytes of window data processed at once
+
+    Frequency map analysis: the tune of every particle in the two consecutive windows of Q_step turns
+    starting at turn start, all found by peak_tunes in one pass over blocks of particles. Only those
+    2 Q_step turns are read. The diffusion index D = log10 sqrt(dQX^2 + dQY^2) of the tune change
+    between the windows is small for regular and large for chaotic motion.
+    A plane without motion gets NaN tunes and is left out of D.
+
+    Returns
+    -------
+        fma : DataFrame with one row per particle of the initial position (X0, Y0), the amplitude of the
+              tune line in the first window (AX, AY), the tunes in both windows (QX1, QX2, QY1, QY2),
+              their changes (dQX, dQY) and the diffusion index D
+    '''
+    import pandas as pd
+    X_pos = Tracks[0]
+    coord = {'X': 0, 'Xp':1, 'Y':2, 'Yp':3}
+    N_turns = np.shape(X_pos)[2]
+    if start + 2*Q_step > N_turns:
+        raise ValueError(f'Two windows of {Q_step} turns from turn {start} need {start + 2*Q_step} turns, the tracks have {N_turns}')
+    columns = {}
+    block = max(1, int(memory / (32 * Q_step)))                # Particles per read
+    for plane in planes:
+        x0, amp, q = np.zeros(n_particles), np.zeros(n_particles), np.zeros((n_particles, 2))
+        for p0 in tqdm(range(0, n_particles, block), desc=f'Frequency map {plane}'):
+            x_pos = np.asarray(X_pos[coord[plane], p0:min(p0+block, n_particles), start:start + 2*Q_step], dtype=np.float64)
+            if np.any(x_pos):
+                tunes, amplitudes = peak_tunes(x_pos.reshape(-1, Q_step), iterations, amplitude=True)
+            else:                                              # e.g. the vertical plane of a 4D tracking
+                tunes, amplitudes = np.zeros(2*len(x_pos)), np.zeros(2*len(x_pos))
+            x0[p0:p0+block] = x_pos[:, 0]
+            amp[p0:p0+block] = amplitudes[::2]
+            q[p0:p0+block] = np.where(amplitudes > 0, tunes, np.nan).reshape(-1, 2)
+        columns.update({f'{plane}0': x0, f'A{plane}': amp, f'Q{plane}1': q[:, 0], f'Q{plane}2': q[:, 1],
+                        f'dQ{plane}': q[:, 1] - q[:, 0]})
+    dq = np.array([columns[f'dQ{plane}'] for plane in planes])
+    with np.errstate(divide='ignore'):
+        columns['D'] = np.where(np.all(np.isnan(dq), axis=0), np.nan, np.log10(np.sqrt(np.nansum(dq**2, axis=0))))
+    return pd.DataFrame(columns, index=pd.RangeIndex(n_particles, name='particle'))
+
+def track_source(X_pos, plane, n_particles, block=256):
+    '''
+    Inputs
+    -------
+        X_pos       : 6 x Np x nturns track array, np.memmap or TrackFile
+        plane       : coordinate index, 0 for X
+        n_particles : number of particles used
+        block       : particles copied at a time when a copy is needed
+
+    Describes X_pos[plane, :n_particles] so that worker processes can open it themselves instead of
+    being sent the data. A TrackFile on disk is reopened by name and a np.memmap is mapped again at the
+    same place in its file. Anything else is copied once into a temporary .npy file, in shared memory
+    (/dev/shm) where there is one, which the workers memory-map.
+
+    Returns
+    -------
+        source    : tuple passed to read_source()
+        temporary : name of the temporary file to remove once the workers are done, or None
+    '''
+    import mmap
+    import tempfile
+    if isinstance(X_pos, TrackFile):
+        root = X_pos
+        while isinstance(root.filename, TrackFile):
+            root = root.filename
+        if isinstance(root.filename, str):
+            return ('trackfile', root.filename, X_pos.obs, plane), None
+    if isinstance(X_pos, np.memmap) and X_pos.filename is not None and X_pos._mmap is not None:
+        view = X_pos[plane, :n_particles]
+        start = X_pos.offset - X_pos.offset % mmap.ALLOCATIONGRANULARITY       # File position of the mapping
+        offset = start + view.ctypes.data - np.frombuffer(X_pos._mmap, np.uint8).ctypes.data
+        return ('memmap', X_pos.filename, offset, view.shape, view.strides, view.dtype.str), None
+
+    fd, temporary = tempfile.mkstemp(suffix='.npy', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    os.close(fd)
+    copy = np.lib.format.open_memmap(temporary, mode='w+', dtype=X_pos.dtype, shape=(n_particles, np.shape(X_pos)[2]))
+    for p0 in range(0, n_particles, block):
+        copy[p0:p0+block] = X_pos[plane, p0:min(p0+block, n_particles), :]
+    copy.flush()
+    return ('memmap', temporary, copy.offset, copy.shape, copy.strides, copy.dtype.str), temporary
+
+def read_source(source, p0, p1):
+    'Positions of particles p0 to p1 from a track_source() description'
+    kind, *args = source
+    if kind == 'trackfile':
+        filename, obs, plane = args
+        return TrackFile(filename, obs)[plane, p0:p1, :]
+    filename, offset, shape, strides, dtype = args
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    return np.array(np.ndarray(shape, dtype, buffer=data, offset=offset, strides=strides)[p0:p1])
+
+def tune_block(source, p0, p1, turns, Q_step, backend):
+    'Worker of tune_parallel, tunes of particles p0 to p1 with the PyNAFF, FFT or Sliding backend'
+    x_pos = read_source(source, p0, p1)
+    if backend == 'FFT':
+        return p0, fft_scroll(x_pos, turns, Q_step)
+    if backend == 'Sliding':
+        return p0, sliding_scroll(x_pos, turns, Q_step)
+    return p0, naff_scroll(x_pos, turns, Q_step)
+
+def tune_parallel(Tracks, n_particles, t_step, Q_step, param='X', workers=os.cpu_count(), backend='PyNAFF'):
+    '''
+    Inputs
+    -------
+        Tracks, n_particles, t_step, Q_step, param : as tune_scroll
+        workers : number of processes
+        backend : 'PyNAFF', 'FFT' or 'Sliding'
+
+    Same result as tune_scroll, tune_fft or tune_sliding, with the particles split into blocks computed by a process pool.
+    Workers read their particles from the file given by track_source(), so the tracks are never pickled. Each block is written into its particle range of Q as it finishes and the
+    progress bar advances by one block.
+
+    Returns
+    -------
+        Q : 2 x n_particles x n_windows array of tunes and of the turn each window ends on
+    '''
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    X_pos = Tracks[0]
+    coord = {'X': 0, 'Xp':1, 'Y':2, 'Yp':3}
+    N_turns = np.shape(X_pos)[2]
+    turns = np.arange(int(N_turns/t_step)) * t_step
+    Q = np.zeros((2, n_particles, len(turns)))
+    Q[1] = turns
+    blocks = np.array_split(np.arange(n_particles), min(n_particles, 8 * workers))   # Several blocks per worker balances the load
+    source, temporary = track_source(X_pos, coord[param], n_particles)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(tune_block, source, idx[0], idx[-1] + 1, turns, Q_step, backend)
+                       for idx in blocks if len(idx)]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                p0, tunes = future.result()
+                Q[0, p0:p0+len(tunes)] = tunes
+    finally:
+        if temporary is not None:
+            os.remove(temporary)
+    return Q
+
+def benchmark_tunes(Tracks, n_particles, t_step, Q_step, param='X', iterations=2):
+    '''
+    Runs tune_scroll (PyNAFF) and tune_fft on the same windows.
+
+    Returns
+    -------
+        dictionary of the run times of both, the speed-up and the largest and rms tune difference
+    '''
+    import time
+    start = time.perf_counter()
+    Q_naff = tune_scroll(Tracks, n_particles, t_step, Q_step, param)
+    t_naff = time.perf_counter() - start
+    start = time.perf_counter()
+    Q_fft = tune_fft(Tracks, n_particles, t_step, Q_step, param, iterations)
+    t_fft = time.perf_counter() - start
+    diff = (Q_fft[0] - Q_naff[0])[:, Q_naff[1, 0] - Q_step > 0]
+    return {'PyNAFF [s]': t_naff, 'FFT [s]': t_fft, 'speed-up': t_naff / t_fft,
+            'max |dQ|': np.max(np.abs(diff), initial=0), 'rms dQ': np.sqrt(np.mean(diff**2)) if diff.size else 0}
+
 
 def TuneDashboard(Tracks):
     '''
@@ -44,6 +413,12 @@ def TuneDashboard(Tracks):
     WindowStep = widgets.BoundedIntText(value=10,  min=1, max=2**15, step=1, description='Window Step')
     Coordinate = widgets.ToggleButtons(options=['X', 'Y'], value='X',  description = 'Coordinate', layout=widgets.Layout(width='auto'))
     nparticles = widgets.BoundedIntText(value=100  , min=0, max=1E10, step=100, description='Particle no.')
+    Backend = widgets.ToggleButtons(options=['PyNAFF', 'FFT', 'Sliding'], value='FFT', description='Backend', layout=widgets.Layout(width='auto'))
+    Workers = widgets.BoundedIntText(value=1, min=1, max=os.cpu_count(), description='Workers')
+    FMAStart = widgets.BoundedIntText(value=0, min=0, max=1E10, step=100, description='FMA start')
+    QX_r = widgets.FloatText(value=5/3, description=r'$Q_{X_{res}}$', step=0.001)
+    FMA = widgets.Button(description='Frequency Map')
+    FMADownload = widgets.Output()
 
     Calculate = widgets.Button(description='Calculate')
     Download = widgets.Output() # Button(description='Download')
@@ -53,7 +428,7 @@ def TuneDashboard(Tracks):
     
     TuneOut = widgets.Output()
     
-    TuneInputs = widgets.HBox([ widgets.VBox([WindowCalc, WindowStep, nparticles, Coordinate]), widgets.VBox([widgets.HBox([Calculate, Download]), Upload, PlotOutput])       ])
+    TuneInputs = widgets.HBox([ widgets.VBox([WindowCalc, WindowStep, nparticles, Coordinate, Backend, Workers]), widgets.VBox([widgets.HBox([Calculate, Download]), Upload, PlotOutput, FMAStart, QX_r, widgets.HBox([FMA, FMADownload])])       ])
     
     TunePlotOut = widgets.Output()
     Tunes = []
@@ -61,33 +436,20 @@ def TuneDashboard(Tracks):
     def TuneCalc(change):
         TuneOut.clear_output()
         with TuneOut:
-            qx = tune_scroll(Tracks, nparticles.value, WindowStep.value, WindowCalc.value, Coordinate.value)
+            if Workers.value > 1:
+                qx = tune_parallel(Tracks, nparticles.value, WindowStep.value, WindowCalc.value, Coordinate.value,
+                                   Workers.value, Backend.value)
+            else:
+                tune_calc = {'PyNAFF': tune_scroll, 'FFT': tune_fft, 'Sliding': tune_sliding}[Backend.value]
+                qx = tune_calc(Tracks, nparticles.value, WindowStep.value, WindowCalc.value, Coordinate.value)
             Tunes.append(qx)
             filename = f'Tune_{Coordinate.value}_{WindowCalc.value}_T_{np.max(qx[1,:,:])}_P_{nparticles.value}.npy'
             
             QX = np.save(filename, qx)
             
-            with open(filename, mode='rb') as file: # b is important -> binary
-                QX_file = file.read()
-           
-                b64 = base64.b64encode(QX_file)
-                payload = b64.decode()
-                
-                html_buttons = '''<html>
-                            <head>
-                            <meta name="viewport" content="width=device-width, initial-scale=1">
-                            </head>
-                            <body>
-                            <a download="{filename}" href="data:text/csv;base64,{payload}" download>
-                            <button class="p-Widget jupyter-widgets jupyter-button widget-button mod-warning">Download File</button>
-                            </a>
-                            </body>
-                            </html>
-                            '''
-                html_button = html_buttons.format(payload=payload,filename=filename)
             with Download:
                 Download.clear_output()
-                display(widgets.HTML(html_button))
+                display(download_button(filename))
             with PlotOutput:
                 PlotOutput.clear_output()
                 display(Plot)
@@ -101,5 +463,27 @@ def TuneDashboard(Tracks):
         with TunePlotOut:
             display(TunePlotDash(Tunes, Tracks))
     
+    def FrequencyMap(change):
+        'Frequency map of the two windows of Window Calc turns from FMA start'
+        TuneOut.clear_output()
+        with TuneOut:
+            try:
+                fma = frequency_map(Tracks, nparticles.value, WindowCalc.value, FMAStart.value)
+            except ValueError as err:
+                CRED = '\033[91m'
+                CEND = '\033[0m'
+                print(CRED + f'Error: {err}' + CEND)
+                return
+            filename = f'FMA_{WindowCalc.value}_T_{FMAStart.value}_P_{nparticles.value}.csv'
+            fma.to_csv(filename)
+            with FMADownload:
+                FMADownload.clear_output()
+                display(download_button(filename))
+        TunePlotOut.clear_output()
+        with TunePlotOut:
+            FrequencyMapPlot(fma, QX_r.value)
+
+    FMA.on_click(FrequencyMap)
+    
     TuneDash = widgets.VBox([TuneInputs, TuneOut, TunePlotOut])
     return TuneDash
\ No newline at end of file
@@ -28,8 +28,12 @@ def TuneOneParticle(tunes, trackdata):
     
     tuneparticle = widgets.Output()
     
-    Xmin = np.min(Tracks[0,:,:][Tracks[0,:,:] != 0])
-    Xmax = np.max(Tracks[0,:,:])
+    def particle_limits(n):
+        'X range of particle n alone, Tracks may be a memory-mapped file far larger than memory'
+        X = np.asarray(Tracks[0, n, :])
+        return np.min(X[X != 0], initial=np.max(X)), np.max(X)
+
+    Xmin, Xmax = particle_limits(0)
     Qmin = np.min(Tunes[0,:,:][Tunes[0,:,:] != 0])
     Qmax = np.max(Tunes[0,:,:])
     
@@ -60,7 +64,13 @@ def TuneOneParticle(tunes, trackdata):
         fig.tight_layout()
         plt.show()
     
+    shown = [0]
+
     def tuneoneplot(b):
+        if num_p.value != shown[0]:
+            # A new particle gets its own X range, the limits stay editable for the same particle
+            xmin.value, xmax.value = particle_limits(num_p.value)
+            shown[0] = num_p.value
         ax1.clear(), ax2.clear()
         with tuneparticle:
 
@@ -77,6 +87,36 @@ def TuneOneParticle(tunes, trackdata):
     return TuneOneDashboard
         
 
+def FrequencyMapPlot(fma, QX_r=5/3):
+    '''
+    Tune footprint and diffusion map of a frequency_map() table, both coloured by the diffusion index D.
+    The resonant tune QX_r is drawn at its fractional part folded into [0, 0.5], where the tunes are found.
+    Each plot is one rasterized scatter, so 10^5 particles draw quickly.
+    '''
+    q_r = QX_r % 1
+    q_r = min(q_r, 1 - q_r)
+    D = fma['D'].to_numpy()
+    finite = np.isfinite(D)
+    norm = Norm(*np.percentile(D[finite], [1, 99])) if finite.any() else None
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14,6))
+    if 'QY1' in fma and fma['QY1'].notna().any():
+        y, ylabel = fma['QY1'], r'$Q_Y$'
+    else:                                                      # No vertical motion, footprint against amplitude
+        y, ylabel = fma['AX'], 'X amplitude [m]'
+    sc = ax1.scatter(fma['QX1'], y, c=D, s=2, cmap='jet', norm=norm, rasterized=True)
+    ax1.axvline(q_r, color='black', linestyle='--', label=r'$Q_{X_{res}}$')
+    ax1.set_xlabel(r'$Q_X$'), ax1.set_ylabel(ylabel)
+    ax1.set_title('Tune footprint'), ax1.legend()
+
+    ax2.scatter(fma['QX1'] - q_r, D, c=fma['AX'], s=2, cmap='viridis', rasterized=True)
+    ax2.axvline(0, color='black', linestyle='--')
+    ax2.set_xlabel(r'$Q_X - Q_{X_{res}}$'), ax2.set_ylabel(r'D = log$_{10}$|$\Delta$Q|')
+    ax2.set_title('Diffusion map, coloured by X amplitude')
+    fig.colorbar(sc, ax=ax1, label='D')
+    fig.tight_layout()
+    plt.show()
+
 def TunePlotDash(tunedata, trackdata):
     ''''''
     tuneturn = widgets.Output()
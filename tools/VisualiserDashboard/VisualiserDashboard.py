@@ -4,29 +4,41 @@ import numpy as np
 import pandas as pd
 from tqdm.notebook import tqdm
 import io
+import zipfile
 
 from tools.VisualiserDashboard.PhaseSpace import PhaseSpaceInputs
 from tools.VisualiserDashboard.TuneCalc import TuneDashboard
+from tools.TrackFile import TrackFile
+from tools.TrackResults import results, subscribe
 
 def Visualiser():
     'Dashboard for producing and editing figures based on 6D tracking data'
 
     '====================== Uploader Inputs ============================'
     htitle = widgets.HTML('<h2> Upload 6D Tracking Data </h2>')
-    hdetails = widgets.HTML('Numpy of the format: X, Xp, Y, Yp, t, pt in a 6 x nparticles x nturns array')
-    form = widgets.Dropdown(options=['Numpy Array'], description='File Type')
+    hdetails = widgets.HTML('Numpy of the format: X, Xp, Y, Yp, t, pt in a 6 x nparticles x nturns array, or n_obs x 6 x nparticles x nturns')
+    form = widgets.Dropdown(options=['Numpy Array', 'Chunked Track File'], description='File Type')
     uploader = widgets.FileUpload(accept='.npy', description='6D Track Results', layout=widgets.Layout(width='auto'))
+    observer = widgets.Dropdown(options=[], description='Observe at')
+    path = widgets.Text(placeholder='Track file on the server', description='Server file', layout=widgets.Layout(width='400px'))
+    load = widgets.Button(description='Load', icon='folder-open')
+    load_err = widgets.Output()
+    kernel = widgets.Dropdown(options=list(results), value=None, description='Kernel result', layout=widgets.Layout(width='400px'))
     
-    Upload = widgets.VBox([htitle, hdetails, widgets.HBox([widgets.VBox([widgets.HBox([form, uploader])])])])
+    Upload = widgets.VBox([htitle, hdetails, widgets.HBox([widgets.VBox([widgets.HBox([form, uploader, observer]), widgets.HBox([path, load, load_err]), kernel])])])
     
     trackdata = []
+    loaded = []
     
     '====================== Uploader Data Handling ============================'
     
     def data_type(change):
         if form.value == 'Numpy Array':
-                hdetails.value = 'Numpy of the format: X, Xp, Y, Yp, t, pt in a 6 x nparticles x nturns array'
+                hdetails.value = 'Numpy of the format: X, Xp, Y, Yp, t, pt in a 6 x nparticles x nturns array, or n_obs x 6 x nparticles x nturns'
                 uploader.accept = '.npy'
+        if form.value == 'Chunked Track File':
+                hdetails.value = 'Chunked Track (.npz) from the Tracking Code tab, only the plotted turns and particles are read'
+                uploader.accept = '.npz'
         if form.value == 'PTC Track File':
                 hdetails.value ='Output from PTCTrack.onetxt'
                 uploader.accept = '.onotxt'
@@ -34,16 +46,70 @@ def Visualiser():
                 hdetails.value = 'Dataframe of format Particle No, Turn No, X, PX, Y, PY, T, PT, S, E'
                 uploader.accept = '.csv'
                 
+    def select_observer(change):
+        'Points trackdata at the chosen observation point of an n_obs x 6 x nparticles x nturns array, without copying'
+        Tracks = loaded[0]
+        if Tracks.ndim == 4:
+            trackdata[:] = [Tracks[observer.value]]
+        else:
+            trackdata[:] = [Tracks]
+                
+    def show_tracks(Tracks, meta={}):
+        'Makes Tracks the dataset used by the phase space and tune dashboards'
+        loaded[:] = [Tracks]
+        if Tracks.ndim == 4:
+            meta = getattr(Tracks, 'meta', meta)
+            names = meta.get('observation_points', [f'Observation point {k}' for k in range(len(Tracks))])
+            observer.options = [(name, k) for k, name in enumerate(names)]
+            observer.value = min(1, len(Tracks) - 1)       # First point after the start of the lattice
+        else:
+            observer.options = []
+        select_observer(None)
+                
     def form_upload(change):
         TracksB = io.BytesIO(uploader.data[0])
-        Tracks = np.load(TracksB)
+        if form.value == 'Chunked Track File':
+            Tracks = TrackFile(TracksB)
+        else:
+            Tracks = np.load(TracksB)
         if form.value == 'PTC Track File':
             tracks = pd.read_csv(seq, delim_whitespace=True, names=['Number', 'Turn', 'X', 'PX', 'Y', 'PY', 'T', 'PT', 'S', 'E'], header = 6, skiprows=2)
-        trackdata.append(Tracks)
+        show_tracks(Tracks)
+        
+    def path_load(b):
+        'Memory-maps a .npy or opens a chunked track file on the server, turns and particles are only read from disk when plotted'
+        load_err.clear_output()
+        try:
+            if zipfile.is_zipfile(path.value):
+                show_tracks(TrackFile(path.value))
+            else:
+                show_tracks(np.load(path.value, mmap_mode='r'))
+        except (OSError, ValueError, KeyError) as err:
+            with load_err:
+                CRED = '\033[91m'
+                CEND = '\033[0m'
+                print(CRED + f'Error: {err}' + CEND)
     
             
+    def kernel_select(change):
+        'Uses a result published by the Tracking Code tab, by reference'
+        if kernel.value is not None:
+            show_tracks(*results[kernel.value])
+            
+    def kernel_published(name):
+        'Lists a newly published result, keeping the current selection and reloading it if it was replaced'
+        current = kernel.value
+        kernel.options = list(results)
+        kernel.value = current if current in results else None
+        if current == name:
+            kernel_select(None)
+            
     form.observe(data_type, 'value')
     uploader.observe(form_upload, 'data')
+    observer.observe(select_observer, 'value')
+    load.on_click(path_load)
+    kernel.observe(kernel_select, 'value')
+    subscribe(kernel_published)
     
     '====================== Phase Space Plot ============================'
     PhaseSpaceDash = PhaseSpaceInputs(trackdata)
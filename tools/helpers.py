@@ -1,5 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
+import ipywidgets as widgets
+import os
+import asyncio
+from urllib.parse import quote
 
 from tqdm.notebook import tqdm
 
@@ -127,4 +131,66 @@ def make_beam_dist(N, dpp, betx, bety, alfx, alfy, dx, dy, dpx, dpy, ex, ey):
 def rad(x):
     'Defining radians'
     theta = x * np.pi / 180
-    return theta
\ No newline at end of file
+    return theta
+
+
+def file_url(filename):
+    '''
+    Absolute URL of filename on the Jupyter server, which streams the file from disk in chunks.
+    Under Voila the file is served from voila/files/, relative to the kernel's working directory. Voila only
+    serves extensions matched by VoilaConfiguration.file_allowlist, which .jupyter/voila.json extends to the
+    .tfs, .txtone, .csv, .npy and .npz files of the dashboards.
+    Otherwise the running Jupyter Server or Notebook server holding the file gives its base URL and root directory.
+    If none is found, the kernel is taken to run in the root directory of the server at JUPYTERHUB_SERVICE_PREFIX, or /.
+    '''
+    path = os.path.abspath(filename)
+    if 'VOILA_BASE_URL' in os.environ:
+        return os.environ['VOILA_BASE_URL'].rstrip('/') + '/voila/files/' + quote(os.path.relpath(path))
+    servers = []
+    for module in ['jupyter_server.serverapp', 'notebook.notebookapp']:
+        try:
+            servers += list(__import__(module, fromlist=['list_running_servers']).list_running_servers())
+        except (ImportError, AttributeError):
+            pass
+    for server in servers:
+        root = os.path.abspath(server.get('root_dir', server.get('notebook_dir', '')))
+        if path.startswith(root + os.sep):
+            return server['base_url'].rstrip('/') + '/files/' + quote(os.path.relpath(path, root))
+    return os.environ.get('JUPYTERHUB_SERVICE_PREFIX', '/').rstrip('/') + '/files/' + quote(os.path.relpath(path))
+
+def download_button(filename):
+    '''
+    Download button linking to filename on the Jupyter server.
+    The browser fetches the file itself, so nothing is read or encoded in the kernel
+    and memory use does not depend on the size of the file.
+    '''
+    html_button = f'''<a download="{os.path.basename(filename)}" href="{file_url(filename)}" target="_blank">
+                     <button class="p-Widget jupyter-widgets jupyter-button widget-button mod-warning">Download File</button>
+                     </a>'''
+    return widgets.HTML(html_button)
+
+def debounce(wait, output=None):
+    '''
+    Decorator for widget callbacks: the callback only runs once no new call has arrived for wait seconds,
+    with the arguments of the last call. Stepping a FloatText several times therefore runs it once.
+    Runs on the kernel's event loop, so plotting from the callback is safe. The event loop would swallow
+    an exception of the callback, so it is printed in the Output widget output instead.
+    '''
+    def decorator(callback):
+        timer = [None]
+        def run(*args, **kwargs):
+            try:
+                callback(*args, **kwargs)
+            except Exception as err:
+                if output is None:
+                    raise
+                with output:
+                    CRED = '\033[91m'
+                    CEND = '\033[0m'
+                    print(CRED + f'Error: {err}' + CEND)
+        def debounced(*args, **kwargs):
+            if timer[0] is not None:
+                timer[0].cancel()
+            timer[0] = asyncio.get_event_loop().call_later(wait, lambda: run(*args, **kwargs))
+        return debounced
+    return decorator